@@ -1,10 +1,49 @@
 from os.path import getsize
-import multiprocessing
-import numpy as np
-import imageio
+import importlib
+import weakref
+import atexit
 import hashlib
+import contextlib
+import io
+import threading
+import json
+import struct
+from time import time, perf_counter
+import zlib
+import bz2
+import lzma
+import collections
+import csv
+import math
+import stat
 import os
 
+class _LazyModule:
+    # Stands in for a heavy module until one of its attributes is first used, then imports it and takes its
+    # place among the globals, so later uses go straight to the module. Keeps CLI calls that don't need
+    # them (usage, info, daemon clients) from paying for their imports
+    def __init__(self, name, alias):
+        self._name, self._alias = name, alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+np = _LazyModule("numpy", "np")
+imageio = _LazyModule("imageio", "imageio")
+multiprocessing = _LazyModule("multiprocessing", "multiprocessing")
+shared_memory = _LazyModule("multiprocessing.shared_memory", "shared_memory")
+resource_tracker = _LazyModule("multiprocessing.resource_tracker", "resource_tracker")
+futures = _LazyModule("concurrent.futures", "futures")
+asyncio = _LazyModule("asyncio", "asyncio")
+
+def _importLazyModules(*aliases):
+    # Imports the modules behind these _LazyModule globals right away
+    for alias in aliases:
+        if isinstance(globals()[alias], _LazyModule):
+            globals()[alias] = importlib.import_module(globals()[alias]._name)
+
 def loadBinaryFile(filename):
     with open(filename, "rb") as f:
         return f.read()
@@ -22,267 +61,2797 @@ def formatBytes(b):
     unit = ["", "K", "M", "G", "T"]
     return "{:.1f} {}B".format(b, unit[count])
 
-class Image:
-    def __init__(self, filename):
-        self.filename = filename
-        
-        self.data = imageio.imread(filename).astype(np.uint8)
-        self.dataSize = getsize(filename)
-        
-        self.width, self.height, self.channels = self.data.shape[:3]
-        assert self.channels >= 3, "Only RGB images are supported. Alpha channels can exist, but will be ignored."
+def symbolsToBytes(symbols, level):
+    # Packs (2**level)-bit symbols (of any unsigned dtype) into bytes, most significant symbol first
+    if level == 0:
+        return np.packbits(symbols).tobytes()
 
-        self.pixels = self.width * self.height
+    step = 2**level
+    if step == 8:
+        return symbols.astype(np.uint8).tobytes()
+
+    symbols = symbols.reshape(-1, 8//step)
+
+    packed = np.zeros(len(symbols), dtype=np.uint8)
+    for bit in range(8//step):
+        packed <<= step
+        packed |= symbols[:, bit]
+
+    return packed.tobytes()
+
+def bytesToSymbols(data, level):
+    # Splits bytes into (2**level)-bit symbols, most significant symbol first
+    data = np.frombuffer(data, dtype=np.uint8)
+
+    if level == 0:
+        return np.unpackbits(data)
+
+    # 1: [6, 4, 2, 0], 2: [4, 0], 3: [0]
+    step = 2**level
+    mask = (2**step) - 1
+    shifts = np.arange(8-step, -1, -step, dtype=np.uint8)
+
+    return ((data[:, None] >> shifts) & mask).reshape(-1)
+
+# Instrumentation
+
+class Stats:
+    # Opt-in profiling: pass one to Image() (or to a single decode/encode call) and read it back afterwards.
+    # Records time per phase, bytes per phase, the chosen level and the amount of workers used
+    def __init__(self):
+        self.durations = {}
+        self.bytes = {}
+        self.level = None
+        self.workers = 1
+
+    @contextlib.contextmanager
+    def phase(self, name, n=0):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + perf_counter() - t0
+            self.bytes[name] = self.bytes.get(name, 0) + n
+
+    def toDict(self):
+        return {"durations": self.durations, "bytes": self.bytes, "level": self.level, "workers": self.workers}
+
+    def printInfo(self):
+        print("Profile (level L{}, {} worker(s)):".format(self.level, self.workers))
+        for name, seconds in sorted(self.durations.items(), key=lambda item: -item[1]):
+            throughput = " ({}/s)".format(formatBytes(self.bytes[name] / seconds)) if self.bytes[name] and seconds else ""
+            print("  {:<8} {:8.4f}s {:>10}{}".format(name, seconds, formatBytes(self.bytes[name]) if self.bytes[name] else "", throughput))
+
+class _NoStats:
+    # Stand-in used when profiling is off: every hook is a no-op on shared objects
+    level = workers = None
+
+    def __setattr__(self, name, value):
+        pass
+
+    def phase(self, name, n=0):
+        return _NO_PHASE
+
+_NO_PHASE = contextlib.nullcontext()
+NO_STATS = _NoStats()
+
+# Header `encoding` flags. Every flag set appends its own fields to the header, right after data-size
+ENCODING_SHARDED = 1 << 0 # Payload split across images: shard-index (2B) + shard-count (2B) + shard-offset (8B) + total-size (8B) + total-hash (32B)
+ENCODING_CHUNKED = 1 << 1 # Data hashed in chunks: chunk-size (4B) + one 32B hash per chunk, with data-hash holding their Merkle root
+ENCODING_COMPRESSED = 1 << 2 # Data stored compressed: compression-method (1B) + original-size (8B)
+ENCODING_MIXED = 1 << 3 # First low-size bytes (header included) at L0, the rest at `level`: low-size (8B)
+KNOWN_ENCODINGS = ENCODING_SHARDED | ENCODING_CHUNKED | ENCODING_COMPRESSED | ENCODING_MIXED
+
+SHARD_FIELDS_SIZE = 2 + 2 + 8 + 8 + 32
+COMPRESSION_FIELDS_SIZE = 1 + 8
+MIXED_FIELDS_SIZE = 8
+
+# Default chunk size of ENCODING_CHUNKED payloads, the smallest unit that can be verified on its own
+HASH_CHUNK_SIZE = 1 << 20
+
+# chunk-size is stored in 4 bytes
+MAX_HASH_CHUNK_SIZE = (1 << 32) - 1
+
+# Reads smaller than this are done in the calling process, as the vectorized reader is faster than dispatching to workers
+PARALLEL_READ_THRESHOLD = 1 << 22
+
+# Default amount of payload bytes streamed at a time by Image.decodePayloadTo() and Image.encodePayload()
+CHUNK_SIZE = 1 << 24
+
+# Chunk hashes
+
+class ChunkIntegrityError(AssertionError):
+    # A chunk of an ENCODING_CHUNKED payload didn't match its hash. chunkIndex pinpoints it
+    def __init__(self, chunkIndex, chunkSize):
+        super().__init__("Payload integrity check failed at chunk {} (data bytes {}-{}). File might be corrupted.".format(
+            chunkIndex, chunkIndex * chunkSize, (chunkIndex+1) * chunkSize))
+        self.chunkIndex = chunkIndex
+
+def hashChunks(data, chunkSize):
+    # SHA-256 of every chunkSize bytes of data (the last chunk can be shorter)
+    data = memoryview(data).cast("B")
+    return [hashlib.sha256(data[s:s+chunkSize]).digest() for s in range(0, data.nbytes, chunkSize)]
+
+def merkleRoot(chunkHashes):
+    # Hashes pairs of nodes level by level (an odd node out goes up as is) until one is left.
+    # No chunks at all gives the hash of empty data, same as a plain data-hash
+    nodes = list(chunkHashes) or [hashlib.sha256().digest()]
+
+    while len(nodes) > 1:
+        nodes = [hashlib.sha256(nodes[i] + nodes[i+1]).digest() if i+1 < len(nodes) else nodes[i] for i in range(0, len(nodes), 2)]
+
+    return nodes[0]
+
+def _findBadChunk(data, chunkHashes, chunkSize, firstChunk=0):
+    # Index of the first chunk of data not matching its hash (data starts at chunk firstChunk), or None
+    data = memoryview(data).cast("B")
+
+    for i, chunkHash in enumerate(chunkHashes):
+        if hashlib.sha256(data[i*chunkSize:(i+1)*chunkSize]).digest() != chunkHash:
+            return firstChunk + i
+
+    return None
+
+# Payload compression
+
+# Payload compression methods: name -> (compression-method byte, compress(data, level), decompress(data)). Level is 0-9 for all of them
+PAYLOAD_COMPRESSORS = {
+    "zlib": (1, lambda data, level: zlib.compress(data, level), zlib.decompress),
+    "bz2": (2, lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress),
+    "lzma": (3, lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+}
+
+# Payload data bytes compressed into each frame. Frames are compressed and decompressed independently, on threads
+COMPRESSION_FRAME_SIZE = 1 << 22
+
+def getPayloadCompressor(methodByte):
+    # Name of the payload compression method stored as methodByte, or None if unknown
+    return next((name for name, compressor in PAYLOAD_COMPRESSORS.items() if compressor[0] == methodByte), None)
+
+class _FrameDecompressor:
+    # Takes the stored data of an ENCODING_COMPRESSED payload in arbitrary pieces and passes it on to write()
+    # decompressed, every complete frame as soon as it arrives (frames arriving together are decompressed on threads)
+    def __init__(self, write, method, stats=NO_STATS):
+        self._write = write
+        self._decompress = PAYLOAD_COMPRESSORS[method][2]
+        self._buffer = bytearray()
+        self.stats = stats
+        self.size = 0
+
+    def write(self, data):
+        self._buffer += data
+
+        # compressed-size (4B) + compressed data, one after the other
+        frames, cur = [], 0
+        while cur + 4 <= len(self._buffer):
+            size = int.from_bytes(self._buffer[cur:cur+4], byteorder="big", signed=False)
+            if cur + 4 + size > len(self._buffer):
+                break
+
+            frames.append(bytes(self._buffer[cur+4:cur+4+size]))
+            cur += 4 + size
+        del self._buffer[:cur]
+
+        with self.stats.phase("decompress", cur):
+            if len(frames) > 1:
+                with futures.ThreadPoolExecutor(min(len(frames), os.cpu_count() or 1)) as executor:
+                    frames = list(executor.map(self._decompress, frames))
+            else:
+                frames = [self._decompress(frame) for frame in frames]
+
+        for frame in frames:
+            self._write(frame)
+            self.size += len(frame)
+
+    def close(self, originalSize):
+        assert not self._buffer and self.size == originalSize, "Payload decompression failed. File might be corrupted."
+
+def _readSharedBytes(imageName, shape, dtype, channelSet, permutation, outName, outOffset, s, n, level, lowSize=0, chunkSize=None, chunkHashes=None, firstChunk=0):
+    # Runs inside a worker: decodes bytes [s, s+n) from a shared image into a shared output buffer.
+    # With chunkHashes, the worker also checks the chunks it decoded, returning the index of the first bad one (or None).
+    # The image is only attached for the task, so idle workers don't keep its pages alive once the parent releases it
+    shm = shared_memory.SharedMemory(name=imageName)
+    try:
+        image = Image.__new__(Image)
+        image.filename = imageName
+        image.channelSet = channelSet
+        image.permutation = permutation
+        image._setData(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+        # Attached before decoding: once a read is given up on, its output block is gone and pending tasks fail right here
+        out = shared_memory.SharedMemory(name=outName)
+        try:
+            data = image._readPackedBytes(s, n, level, lowSize)
+            out.buf[outOffset:outOffset+n] = data
+        finally:
+            out.close()
+    finally:
+        image = None # Drops the views on shm first
+        shm.close()
+
+    if chunkHashes is not None:
+        return _findBadChunk(data, chunkHashes, chunkSize, firstChunk)
+
+def _starReadSharedBytes(args):
+    return _readSharedBytes(*args)
+
+class WorkerPool:
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def _getPool(self):
+        # Workers are only spawned on first use and then reused by every read, from any thread
+        with self._lock:
+            if self._pool is None:
+                # Started first so workers share it, instead of each one tracking (and unlinking) the blocks it attaches
+                resource_tracker.ensure_running()
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+
+    def readBytes(self, image, s, n, level, stats=NO_STATS, chunkSize=None, chunkHashes=None, firstChunk=0, lowSize=0):
+        # Reads payload bytes [s, s+n) with Image._readPackedBytes(), whose first lowSize bytes are at L0.
+        # With chunkHashes (those of the chunkSize chunks starting at s, the first one being chunk firstChunk),
+        # every worker verifies what it decoded and the read stops at the first bad chunk found
+        # Workers are forked before the blocks are created, so they don't inherit mappings of them
+        with stats.phase("spawn"):
+            pool = self._getPool()
+
+        with stats.phase("share"):
+            imageName = image._shareData()
+        out = shared_memory.SharedMemory(create=True, size=max(n, 1))
+        stats.workers = self.processes
+
+        try:
+            if chunkHashes is not None:
+                self._readVerified(pool, imageName, image, out, s, n, level, lowSize, stats, chunkSize, chunkHashes, firstChunk)
+                return bytearray(out.buf[:n])
+
+            # Split workload - each worker will read bytes indexed in range(s, e)
+            args = []
+            for t in range(self.processes):
+                ts = t * (n//self.processes) + min(n%self.processes, t)
+                te = (t+1) * (n//self.processes) + min(n%self.processes, (t+1))
+
+                args.append((imageName, image.data.shape, image.data.dtype, image.channelSet, image.permutation, out.name, ts, s + ts, te-ts, level, lowSize))
+
+            pool.starmap(_readSharedBytes, args)
+
+            return bytearray(out.buf[:n])
+        finally:
+            out.close()
+            out.unlink()
+
+    def _readVerified(self, pool, imageName, image, out, s, n, level, lowSize, stats, chunkSize, chunkHashes, firstChunk):
+        # Split on chunk boundaries, in a few tasks per worker so a bad chunk cuts the read short
+        tasks = min(len(chunkHashes), self.processes * 4)
+
+        args = []
+        for t in range(tasks):
+            cs = t * (len(chunkHashes)//tasks) + min(len(chunkHashes)%tasks, t)
+            ce = (t+1) * (len(chunkHashes)//tasks) + min(len(chunkHashes)%tasks, (t+1))
+            ts, te = cs * chunkSize, min(ce * chunkSize, n)
+
+            args.append((imageName, image.data.shape, image.data.dtype, image.channelSet, image.permutation, out.name, ts, s + ts, te-ts, level, lowSize, chunkSize, chunkHashes[cs:ce], firstChunk + cs))
+
+        for badChunk in pool.imap_unordered(_starReadSharedBytes, args):
+            if badChunk is not None:
+                raise ChunkIntegrityError(badChunk, chunkSize)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+_defaultPool = None
+_defaultPoolLock = threading.Lock()
+
+def getWorkerPool():
+    # Shared pool used by every Image that wasn't given one explicitly
+    global _defaultPool
+
+    with _defaultPoolLock:
+        if _defaultPool is None:
+            _defaultPool = WorkerPool()
+        return _defaultPool
+
+@atexit.register
+def shutdownWorkerPool():
+    global _defaultPool
+
+    if _defaultPool is not None:
+        _defaultPool.shutdown()
+        _defaultPool = None
+
+def _releaseSharedMemory(shm):
+    try:
+        shm.close()
+    except BufferError: # Arrays still point to it, the mapping goes away with them
+        pass
+    shm.unlink()
+
+# PNG writing
+
+# zlib levels for Image.saveFile() compression presets
+COMPRESSION_PRESETS = {"none": 0, "fast": 1, "default": 6, "small": 9}
+
+# Rows are compressed in bands of at least this many bytes, one band per thread at a time
+PNG_BAND_SIZE = 1 << 20
+
+def _pngChunk(chunkType, data):
+    chunk = chunkType + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+
+def _filterRows(rows, prior, bpp):
+    # Picks, for every row, the PNG filter with the smallest sum of absolute (signed) differences,
+    # like libpng does. All filters only look at the original bytes, so every row is done at once.
+    # Returns the rows prefixed with their filter type byte
+    x = rows.astype(np.int16)
+    b = prior.astype(np.int16)
+    a = np.zeros_like(x)
+    a[:, bpp:] = x[:, :-bpp]
+    c = np.zeros_like(x)
+    c[:, bpp:] = b[:, :-bpp]
+
+    # Paeth predictor
+    pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2*c)
+    paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
 
-        self.storageL0 = (self.pixels * 3) // 8
-        self.storageL1 = (self.pixels * 3) * 2 // 8
-        self.storageL2 = (self.pixels * 3) * 4 // 8
+    # None, Sub, Up, Average, Paeth
+    filtered = np.stack([x, x - a, x - b, x - ((a + b) >> 1), x - paeth]).astype(np.uint8)
 
+    signed = filtered.view(np.int8).astype(np.int32)
+    best = np.abs(signed).sum(axis=2).argmin(axis=0)
+
+    out = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+    out[:, 0] = best
+    out[:, 1:] = filtered[best, np.arange(len(rows))]
+
+    return out
+
+def _pngHeaderChunk(shape, dtype):
+    height, width = shape[:2]
+    channels = shape[2] if len(shape) == 3 else 1
+    colorType = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+
+    return _pngChunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8 * dtype.itemsize, colorType, 0, 0, 0))
+
+def writePNG(f, data, level=6, threads=None):
+    # Lossless PNG writer that filters and deflates bands of rows in parallel threads (zlib releases the GIL)
+    f.write(PNG_SIGNATURE)
+    f.write(_pngHeaderChunk(data.shape, data.dtype))
+
+    for piece in _deflatePNGRows(data, level, threads):
+        f.write(_pngChunk(b"IDAT", piece))
+
+    f.write(_pngChunk(b"IEND", b""))
+
+def _deflatePNGRows(data, level=6, threads=None):
+    # Yields the zlib stream of the image data of a PNG in pieces: its header, every band, then its checksum.
+    # Each band but the last ends on a sync flush, so the raw deflate streams can just be concatenated
+    height = data.shape[0]
+    channels = data.shape[2] if data.ndim == 3 else 1
+
+    # Rows as big-endian bytes, as PNG stores 16 bit samples
+    rows = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder(">")).view(np.uint8).reshape(height, -1)
+    bpp = channels * data.dtype.itemsize
+
+    threads = threads or os.cpu_count()
+    bandRows = max(1, min(-(-height // threads), -(-PNG_BAND_SIZE // rows.shape[1])))
+    bands = range(0, height, bandRows)
+
+    def compressBand(i0):
+        i1 = min(i0 + bandRows, height)
+        prior = rows[i0-1:i1-1] if i0 > 0 else np.vstack([np.zeros_like(rows[:1]), rows[:i1-1]])
+
+        filtered = _filterRows(rows[i0:i1], prior, bpp) if level > 0 else np.hstack([np.zeros((i1-i0, 1), dtype=np.uint8), rows[i0:i1]])
+
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(filtered) + compressor.flush(zlib.Z_FINISH if i1 == height else zlib.Z_SYNC_FLUSH)
+
+        return compressed, zlib.adler32(filtered)
+
+    yield bytes([0x78, 0x01])
+
+    adler = 1
+    with futures.ThreadPoolExecutor(threads) as executor:
+        for i0, (compressed, bandAdler) in zip(bands, executor.map(compressBand, bands)):
+            yield compressed
+
+            # adler32 can't be combined, so it's chained over the filtered bytes, which are gone by now
+            adler = _adler32Combine(adler, bandAdler, (min(i0 + bandRows, height) - i0) * (rows.shape[1] + 1))
+
+    yield struct.pack(">I", adler)
+
+def _adler32Combine(adler1, adler2, length2):
+    # Same as zlib's adler32_combine(): checksum of A+B from the checksums of A and B and the length of B
+    BASE = 65521
+
+    rem = length2 % BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % BASE
+    sum1 += (adler2 & 0xffff) + BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + BASE - rem
+
+    sum1 %= BASE
+    sum2 %= BASE
+
+    return (sum2 << 16) | sum1
+
+# Raw pixel cache: a fixed 32 byte header followed by the pixels as they are in memory, so they can be
+# memory-mapped instead of decoded. magic (8B) + width (4B) + height (4B) + channels (4B) + dtype (4B) + padding (8B)
+RAW_MAGIC = b"StegoRaw"
+RAW_HEADER_SIZE = 32
+RAW_EXTENSION = ".raw"
+
+def isRawCache(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(RAW_MAGIC)) == RAW_MAGIC
+
+def _parseRawHeader(header, filename):
+    if header[:len(RAW_MAGIC)] != RAW_MAGIC:
+        raise ValueError("'{}' is not a raw pixel cache.".format(filename))
+
+    shape = tuple(int.from_bytes(header[i:i+4], byteorder="big", signed=False) for i in [8, 12, 16])
+    dtype = np.dtype(bytes(header[20:24]).rstrip(b"\0").decode("ascii"))
+
+    return shape, dtype
+
+def loadRawCache(filename, mode="c"):
+    # mode is passed to np.memmap: "c" (copy-on-write) keeps changes in memory only, "r+" writes them to the cache
+    with open(filename, "rb") as f:
+        shape, dtype = _parseRawHeader(f.read(RAW_HEADER_SIZE), filename)
+
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=RAW_HEADER_SIZE, shape=shape)
+
+def loadRawCacheBuffer(buffer):
+    # Same as loadRawCache() over an in-memory buffer, without copying it (read-only buffers give read-only arrays)
+    shape, dtype = _parseRawHeader(buffer[:RAW_HEADER_SIZE], "<memory>")
+
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=RAW_HEADER_SIZE).reshape(shape)
+
+def saveRawCache(data, filename):
+    # filename can also be a binary file object
+    header = bytearray(RAW_MAGIC)
+    for size in data.shape:
+        header += size.to_bytes(4, byteorder="big", signed=False)
+    header += data.dtype.str.encode("ascii").ljust(4, b"\0")
+    header = header.ljust(RAW_HEADER_SIZE, b"\0")
+
+    with contextlib.ExitStack() as stack:
+        f = filename if hasattr(filename, "write") else stack.enter_context(open(filename, "wb"))
+        f.write(header)
+        f.write(np.ascontiguousarray(data).data)
+
+# Image decoding
+
+def readImageData(source):
+    # Pixels of an image (filename or binary file object) decoded by imageio, keeping 8 and 16 bit samples as
+    # they are. 16 bit RGB/RGBA PNGs, which imageio (through Pillow) cuts down to 8 bits, are read by readPNG16()
+    with contextlib.ExitStack() as stack:
+        f = source if hasattr(source, "read") else stack.enter_context(open(source, "rb"))
+        head = f.read(26)
+        f.seek(0)
+
+        if head[:8] == PNG_SIGNATURE and head[12:16] == b"IHDR" and head[24] == 16 and head[25] in (2, 6):
+            return readPNG16(f)
+
+    data = imageio.imread(source)
+    return data if data.dtype in (np.uint8, np.uint16) else data.astype(np.uint8)
+
+def readPNG16(f):
+    # Decodes a 16 bit RGB/RGBA PNG from a binary file object. Pillow only keeps the high byte of every sample, but
+    # still unfilters whole 16 bit pixels, so decoding it twice, unpacking the samples as big-endian and then as
+    # little-endian, gives the high bytes and then the low ones
+    from PIL import Image as PILImage
+
+    halves = []
+    for byteOrder in ["B", "L"]:
+        f.seek(0)
+        image = PILImage.open(f)
+        image.tile = [(tile[0], tile[1], tile[2], image.mode + ";16" + byteOrder) for tile in image.tile]
+        image.load()
+        halves.append(np.asarray(image))
+
+    return (halves[0].astype(np.uint16) << 8) | halves[1]
+
+# Lazy loading
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Rows PNGRowReader decodes progressively before the whole image is decoded at once instead
+LAZY_ROW_LIMIT = 256
+
+class PNGRowReader:
+    # Decodes the rows of a non-interlaced 8-bit RGB/RGBA PNG from f progressively, only as far as asked for:
+    # IDAT data is only read and inflated up to the rows needed, so only the rows decoded so far are ever
+    # held in memory. Anything else raises a ValueError
+    def __init__(self, f):
+        self._f = f
+
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError("Not a PNG file.")
+
+        length, chunkType = struct.unpack(">I4s", f.read(8))
+        if chunkType != b"IHDR":
+            raise ValueError("Not a PNG file.")
+
+        columns, rows, bitDepth, colorType, _, _, interlace = struct.unpack(">IIBBBBB", f.read(13))
+        f.seek(length - 13 + 4, os.SEEK_CUR)
+
+        if bitDepth != 8 or colorType not in (2, 6) or interlace:
+            raise ValueError("Only non-interlaced 8-bit RGB/RGBA PNGs can be read row by row.")
+
+        self.shape = (rows, columns, 3 if colorType == 2 else 4)
+        self.rowSize = columns * self.shape[2]
+
+        self._inflater = zlib.decompressobj()
+        self._inflated = bytearray()
+        self._idatLeft = 0
+        self._rows = bytearray()
+        self.rowsRead = 0
+
+    def close(self):
+        self._f.close()
+
+    def _readIDAT(self, n=1 << 16):
+        # Up to n more bytes of the (concatenated) IDAT chunks, b"" once they're over
+        while self._idatLeft == 0:
+            header = self._f.read(8)
+            if len(header) < 8:
+                return b""
+
+            length, chunkType = struct.unpack(">I4s", header)
+            if chunkType == b"IEND":
+                return b""
+            if chunkType != b"IDAT" or length == 0:
+                self._f.seek(length + 4, os.SEEK_CUR)
+                continue
+
+            self._idatLeft = length
+
+        data = self._f.read(min(n, self._idatLeft))
+        self._idatLeft -= len(data)
+        if self._idatLeft == 0:
+            self._f.seek(4, os.SEEK_CUR) # CRC
+
+        return data
+
+    def readRows(self, i0, i1):
+        # Rows [i0, i1) as a (i1-i0, columns, channels) array, decoding up to row i1 if not done yet
+        if self.rowsRead < i1:
+            n = i1 - self.rowsRead
+            while len(self._inflated) < n * (self.rowSize + 1):
+                data = self._readIDAT()
+                if not data:
+                    raise ValueError("PNG data ended after {} of {} rows.".format(self.rowsRead, self.shape[0]))
+                self._inflated += self._inflater.decompress(data)
+
+            self._rows += self._unfilter(self._inflated[:n * (self.rowSize + 1)])
+            del self._inflated[:n * (self.rowSize + 1)]
+            self.rowsRead = i1
+
+        return np.frombuffer(self._rows, dtype=np.uint8, count=(i1-i0) * self.rowSize, offset=i0 * self.rowSize).reshape(i1-i0, *self.shape[1:]).copy()
+
+    def _unfilter(self, filtered):
+        # Unfilters rows (filter type byte + row, each) following the ones decoded so far. Filters depend on the row
+        # before, so that row goes first, unfiltered (filter type 0), into a PNG of just these rows stored
+        # uncompressed, which imageio then decodes (in C)
+        prior = self._rows[-self.rowSize:] if self.rowsRead else bytearray(self.rowSize)
+        rows = len(filtered) // (self.rowSize + 1) + 1
+
+        f = io.BytesIO()
+        f.write(PNG_SIGNATURE)
+        f.write(_pngChunk(b"IHDR", struct.pack(">IIBBBBB", self.shape[1], rows, 8, 2 if self.shape[2] == 3 else 6, 0, 0, 0)))
+        f.write(_pngChunk(b"IDAT", zlib.compress(b"\0" + prior + filtered, 0)))
+        f.write(_pngChunk(b"IEND", b""))
+        f.seek(0)
+
+        return imageio.imread(f, format="PNG")[1:].tobytes()
+
+# Keyed scatter
+
+# Subpixel indexes permuted at a time, bounding the memory used for them to a few of these int64 arrays
+PERMUTATION_BLOCK_SIZE = 1 << 20
+
+class KeyedPermutation:
+    # Bijection of [0, size) picked by a key (str, bytes or int): a 4-round Feistel network over the smallest
+    # power of 4 covering size, with indexes landing outside walked through it again until they're back in range.
+    # Every index is computed on its own, so any range of them can be computed without the rest
+    def __init__(self, key, size):
+        if not isinstance(key, (bytes, bytearray)):
+            key = str(key).encode("UTF-8")
+
+        self.size = size
+        self.halfBits = max(((size - 1).bit_length() + 1) // 2, 1)
+        self.roundKeys = [np.uint64(k) for k in struct.unpack(">4Q", hashlib.sha256(key).digest())]
+
+    def _feistel(self, x):
+        halfMask = np.uint64((1 << self.halfBits) - 1)
+        halfBits = np.uint64(self.halfBits)
+        left, right = x >> halfBits, x & halfMask
+
+        for roundKey in self.roundKeys:
+            # Keyed multiply-xorshift of the right half (uint64 arithmetic wraps around), in place
+            z = right + roundKey
+            z *= np.uint64(0x9E3779B97F4A7C15)
+            z ^= z >> np.uint64(29)
+            z *= np.uint64(0xBF58476D1CE4E5B9)
+            z ^= z >> np.uint64(32)
+            z &= halfMask
+            z ^= left
+            left, right = right, z
+
+        return (left << halfBits) | right
+
+    def __call__(self, indexes):
+        permuted = self._feistel(np.asarray(indexes, dtype=np.uint64))
+
+        outside = np.flatnonzero(permuted >= self.size)
+        while len(outside):
+            permuted[outside] = self._feistel(permuted[outside])
+            outside = outside[permuted[outside] >= self.size]
+
+        return permuted.astype(np.int64)
+
+    def blocks(self, s, e):
+        # (offset, permuted indexes) of [s, e), PERMUTATION_BLOCK_SIZE at a time
+        for bs in range(s, e, PERMUTATION_BLOCK_SIZE):
+            yield bs - s, self(np.arange(bs, min(bs + PERMUTATION_BLOCK_SIZE, e), dtype=np.uint64))
+
+# Channels carrying the payload unless told otherwise: RGB, leaving alpha alone
+DEFAULT_CHANNEL_SET = (0, 1, 2)
+
+def _parseChannelSet(channelSet):
+    # Channel indexes of a channel set given as indexes or letters ("rgba")
+    return tuple("rgba".index(c) for c in channelSet.lower()) if isinstance(channelSet, str) else tuple(channelSet or DEFAULT_CHANNEL_SET)
+
+class Image:
+    def __init__(self, filename, pool=None, rawMode="c", stats=None, key=None, lazy=False, channelSet=None):
+        # filename can also be the encoded image itself, as bytes, bytearray, memoryview or a binary file object.
+        # Raw pixel caches (see saveRaw()) are memory-mapped with rawMode (or used in place, if in memory),
+        # anything else is decoded by imageio.
+        # With a key, payloads are spread over the image in the order of a KeyedPermutation of its subpixels
+        # instead of from its first pixel onwards, and can only be found again with the same key.
+        # With lazy, PNGs only have their header read at first, and then only the rows reads actually touch
+        # are decoded (up to LAZY_ROW_LIMIT of them), so detecting and decoding small payloads stays cheap.
+        # channelSet picks the channels carrying the payload, as indexes or letters ("rgba" to use alpha too),
+        # and is needed again to decode it. 8 and 16 bit samples are kept as they are, 16 bit ones adding L3
+        self.pool = pool
+        self.channelSet = _parseChannelSet(channelSet)
+        self.stats = stats or NO_STATS
+        self._data = None
+        self._rowReader = None
+
+        if hasattr(filename, "read"):
+            self.filename = getattr(filename, "name", "<stream>")
+            filename = filename.read()
+        else:
+            self.filename = "<memory>" if isinstance(filename, (bytes, bytearray, memoryview)) else filename
+
+        if isinstance(filename, (bytes, bytearray, memoryview)):
+            buffer = memoryview(filename).cast("B")
+            self.dataSize = buffer.nbytes
+
+            with self.stats.phase("load", self.dataSize):
+                if buffer[:len(RAW_MAGIC)] == RAW_MAGIC:
+                    self._setData(loadRawCacheBuffer(buffer))
+                else:
+                    # BytesIO shares bytes objects instead of copying them
+                    self._source = filename if isinstance(filename, bytes) else buffer
+                    if not (lazy and self._openLazily(io.BytesIO(self._source))):
+                        self._setData(readImageData(io.BytesIO(self._source)))
+        else:
+            self.dataSize = getsize(filename)
+
+            with self.stats.phase("load", self.dataSize):
+                if isRawCache(filename):
+                    self._setData(loadRawCache(filename, rawMode))
+                else:
+                    self._source = filename
+                    if not (lazy and self._openLazily(open(filename, "rb"))):
+                        self._setData(readImageData(filename))
+
+        self.permutation = KeyedPermutation(key, self.subpixels) if key is not None else None
         self._cur = 0
 
-    def saveFile(self, filename):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def data(self):
+        # Lazily opened images are fully decoded the first time all of their pixels are needed
+        if self._data is None and self._rowReader is not None:
+            with self.stats.phase("load", self.dataSize):
+                source = io.BytesIO(self._source) if isinstance(self._source, (bytes, memoryview)) else self._source
+                self._data = readImageData(source)
+
+            self._rowReader.close()
+            self._rowReader = None
+
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def _openLazily(self, f):
+        # Reads only the header of a PNG, leaving its rows to be decoded on demand. False if it can't be read that way
+        try:
+            self._rowReader = PNGRowReader(f)
+        except (ValueError, struct.error):
+            f.close()
+            return False
+
+        self._setShape(self._rowReader.shape)
+        return True
+
+    def _getRows(self, i0, i1):
+        # Rows [i0, i1) of the pixels, only decoding as far as row i1 on lazily opened images
+        if self._data is None and self._rowReader is not None and i1 <= LAZY_ROW_LIMIT:
+            return self._rowReader.readRows(i0, i1)
+
+        return self.data[i0:i1]
+
+    def close(self):
+        # Moves the pixels out of shared memory (if they were shared with workers) and releases it
+        if self._rowReader is not None:
+            self._rowReader.close()
+            self._rowReader = None
+
+        if getattr(self, "_shm", None) is not None:
+            self.data = self.data.copy()
+            self._shmFinalizer()
+            self._shm = None
+
+    def _shareData(self):
+        # Moves the pixels to a shared memory block once, so workers can map them without pickling
+        if getattr(self, "_shm", None) is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=self.data.nbytes)
+            shared = np.ndarray(self.data.shape, dtype=self.data.dtype, buffer=self._shm.buf)
+            shared[...] = self.data
+            self.data = shared
+            self._shmFinalizer = weakref.finalize(self, _releaseSharedMemory, self._shm)
+
+        return self._shm.name
+
+    def _setData(self, data):
+        self.data = data
+        self._setShape(data.shape, data.dtype)
+
+    def _setShape(self, shape, dtype=None):
+        self.width, self.height, self.channels = shape[:3]
+        assert self.channels >= 3, "Only RGB images are supported. Alpha channels can exist, but will be ignored unless in channelSet."
+
+        if not all(0 <= channel < self.channels for channel in self.channelSet) or len(set(self.channelSet)) != len(self.channelSet):
+            raise ValueError("Channel set {} doesn't fit the {} channels of '{}'.".format(self.channelSet, self.channels, self.filename))
+
+        # Channels in channelSet as a slice when they're the first ones in order, so indexing with it gives views
+        planes = len(self.channelSet)
+        self._planeIndex = slice(0, planes) if self.channelSet == tuple(range(planes)) else list(self.channelSet)
+
+        self.pixels = self.width * self.height
+        self.subpixels = self.pixels * planes
+        self.sampleBits = 8 * np.dtype(dtype).itemsize if dtype is not None else 8
+
+        self.storages = getStorages(self.pixels, planes, self.sampleBits)
+        self.storageL0, self.storageL1, self.storageL2 = self.storages[:3]
+
+    def saveFile(self, filename, compression=None, threads=None):
+        # compression is a zlib level (0-9) or one of COMPRESSION_PRESETS. When given, the PNG is written by
+        # writePNG() with that many threads, or by imageio's own writer at that level if threads is 1.
+        # filename can also be a binary file object
         # Replace output file extension to '.png' if it isn't already
-        if not filename.lower().endswith(".png"):
+        if not hasattr(filename, "write") and not filename.lower().endswith(".png"):
             if "." in filename:
                 filename = ".".join(filename.split(".")[:-1])
             filename += ".png"
 
-        imageio.imwrite(filename, self.data)
+        level = COMPRESSION_PRESETS.get(compression, compression)
+
+        # imageio would only keep 8 bits of 16 bit samples, so those always go through writePNG()
+        wide = self.data.dtype != np.uint8
+        if level is None and wide:
+            level = COMPRESSION_PRESETS["default"]
+
+        with self.stats.phase("save", self.data.nbytes):
+            if level is None:
+                imageio.imwrite(filename, self.data, format="PNG")
+            elif threads == 1 and not wide:
+                imageio.imwrite(filename, self.data, format="PNG", compress_level=level)
+            else:
+                with contextlib.ExitStack() as stack:
+                    f = filename if hasattr(filename, "write") else stack.enter_context(open(filename, "wb"))
+                    writePNG(f, self.data, level, threads)
+
+        return filename
+
+    def toBytes(self, compression=None, threads=None):
+        # Encoded PNG, without touching the filesystem
+        f = io.BytesIO()
+        self.saveFile(f, compression, threads)
+        return f.getvalue()
+
+    def saveRaw(self, filename):
+        # Saves the pixels as a raw pixel cache, which later Image() calls open without decoding.
+        # filename can also be a binary file object
+        saveRawCache(self.data, filename)
         return filename
 
     def printInfo(self):
-        print("'{}' has file size {} and".format(self.filename, formatBytes(self.dataSize)), end=" ")
-        print("dimensions {}x{} ({} pixels).".format(self.width, self.height, self.pixels))
-        
-        print("Payload storage capacities (including payload header):")
-        print("  Level 0: up to {}".format(formatBytes(self.storageL0)))
-        print("  Level 1: {} to {}".format(formatBytes(self.storageL0+1), formatBytes(self.storageL1)))
-        print("  Level 2: {} to {}".format(formatBytes(self.storageL1+1), formatBytes(self.storageL2)))
+        _printInfo(self.filename, self.dataSize, self.width, self.height, self.sampleBits, self.storages)
 
-    def hasPayload(self):
-        for testLevel in [0, 1, 2]:
-            self._cur = 0
+    def readHeader(self):
+        with self.stats.phase("detect"):
+            header = self._readHeader()
+
+        if header is not None:
+            self.stats.level = header.level
+            header.image = self
+
+        return header
+
+    def _readHeader(self):
+        # The fixed 3 bytes (encoding + level + filename-size) span at most 24 subpixels (L0),
+        # so they are read once and every candidate level is checked against that same slice
+        head = self._getSubpixels(0, min(3 * 8, self.subpixels))
+
+        for testLevel in range(len(self.storages)):
+            step = 2**testLevel
+            mask = (2**step) - 1
 
-            encoding, level, filenameSize = self.__readNextNBytes(3, testLevel)
-            if not all([encoding == 0, level == testLevel, 0 < filenameSize <= 255]): continue
+            if len(head) < 3 * (8//step): continue
+
+            encoding, level, filenameSize = symbolsToBytes(head[:3 * (8//step)] & mask, testLevel)
+            # Mixed layouts keep their header at L0, with `level` being that of the rest of the payload
+            mixed = testLevel == 0 and encoding & ENCODING_MIXED and 0 < level < len(self.storages)
+            if not all([encoding & ~KNOWN_ENCODINGS == 0, level == testLevel or mixed, 0 < filenameSize <= 255]): continue
 
             try:
-                filename = self.__readNextNBytes(filenameSize, testLevel)
-                filename = filename.decode("UTF-8")
+                fields = self._readNBytes(3, filenameSize + hashlib.sha256().digest_size + 4, testLevel)
+                filename = fields[:filenameSize].decode("UTF-8")
 
                 assert len(filename) == filenameSize
+            except (IndexError, UnicodeDecodeError, AssertionError):
+                continue
+
+            dataHash = bytes(fields[filenameSize:-4])
+            dataSize = int.from_bytes(fields[-4:], byteorder="big", signed=False)
+            header = PayloadHeader(encoding, level, filename, dataHash, dataSize)
+
+            try:
+                if encoding & ENCODING_SHARDED:
+                    header.setShardFields(self._readNBytes(header.size, SHARD_FIELDS_SIZE, testLevel))
+
+                if encoding & ENCODING_CHUNKED:
+                    chunkSize = int.from_bytes(self._readNBytes(header.size, 4, testLevel), byteorder="big", signed=False)
+                    if chunkSize == 0: continue
 
-                return filename, testLevel
-            except:
+                    chunkCount = -(-dataSize // chunkSize)
+                    header.setChunkFields(chunkSize, self._readNBytes(header.size + 4, chunkCount * 32, testLevel))
+
+                if encoding & ENCODING_COMPRESSED:
+                    fields = self._readNBytes(header.size, COMPRESSION_FIELDS_SIZE, testLevel)
+                    if getPayloadCompressor(fields[0]) is None: continue
+
+                    header.setCompressionFields(fields)
+
+                if encoding & ENCODING_MIXED:
+                    header.setMixedFields(self._readNBytes(header.size, MIXED_FIELDS_SIZE, testLevel))
+                    if not header.size <= header.lowSize <= header.size + dataSize: continue
+            except IndexError:
                 continue
 
-        return None, None
+            return header
+
+        return None
+
+    def hasPayload(self):
+        header = self.readHeader()
+
+        if header is None:
+            return None, None
+
+        return header.filename, header.level
+
+    def _getSubpixels(self, s, e):
+        # Subpixels are indexed in row-major order over the channels in channelSet (P of them):
+        # cur -> (cur // (height*P), (cur % (height*P)) // P, channelSet[cur % P])
+        if e > self.subpixels:
+            raise IndexError("Tried to read past the end of '{}'.".format(self.filename))
+
+        # Keyed: a gather of the permuted subpixels, block by block
+        if self.permutation is not None:
+            subpixels = np.empty(e - s, dtype=self.data.dtype)
+            for offset, indexes in self.permutation.blocks(s, e):
+                pixels, where = self._locateSubpixels(indexes)
+                subpixels[offset:offset+len(indexes)] = pixels[where]
+
+            return subpixels
+
+        # Only the band of rows covering [s, e) is flattened (a view when channelSet covers every channel)
+        rowSize = self.height * len(self.channelSet)
+        i0, i1 = s // rowSize, -(-e // rowSize)
+        band = self._getRows(i0, i1)[:, :, self._planeIndex].reshape(-1)
+
+        return band[s - i0*rowSize : e - i0*rowSize]
+
+    def _locateSubpixels(self, indexes):
+        # (array, index) addressing the given subpixel indexes in a single fancy index: the flat indexes themselves
+        # when channelSet covers every channel of a contiguous array, their (rows, columns, channels) otherwise
+        planes = len(self.channelSet)
+        if self._planeIndex == slice(0, self.channels) and self.data.flags.c_contiguous:
+            return self.data.reshape(-1), indexes
+
+        rowSize = self.height * planes
+        channels = indexes % planes if isinstance(self._planeIndex, slice) else np.asarray(self.channelSet)[indexes % planes]
+        return self.data, (indexes // rowSize, (indexes % rowSize) // planes, channels)
+
+    def _writeNBytes(self, s, data, level):
+        # Splits every byte into 8//step symbols and writes them over the matching subpixels only
+        step = 2**level
+        mask = (2**step) - 1
+
+        self._writeSubpixels(s * (8//step), bytesToSymbols(data, level), mask)
+
+    def _writeSubpixels(self, s, symbols, mask):
+        # Replaces the last bits (given by mask) of subpixels [s, s+len(symbols)) with symbols
+        e = s + len(symbols)
+        if e > self.subpixels:
+            raise IndexError("Tried to write past the end of '{}'.".format(self.filename))
+
+        # Pixels used in place from a read-only buffer are only copied once they're written to
+        if not self.data.flags.writeable:
+            self.data = self.data.copy()
+
+        # Bits kept, in the width of the samples
+        keep = np.iinfo(self.data.dtype).max - mask
+
+        # Keyed: a scatter into the permuted subpixels, block by block
+        if self.permutation is not None:
+            for offset, indexes in self.permutation.blocks(s, e):
+                pixels, where = self._locateSubpixels(indexes)
+                pixels[where] = (pixels[where] & keep) | symbols[offset:offset+len(indexes)]
+
+            return
+
+        rowSize = self.height * len(self.channelSet)
+        i0, i1 = s // rowSize, -(-e // rowSize)
+        band = self.data[i0:i1, :, self._planeIndex]
+        flat = band.reshape(-1)
+
+        segment = flat[s - i0*rowSize : e - i0*rowSize]
+        segment &= keep
+        segment |= symbols
+
+        # When channelSet leaves channels out the flattened band is a copy, so it has to be written back
+        if not np.shares_memory(flat, self.data):
+            self.data[i0:i1, :, self._planeIndex] = flat.reshape(band.shape)
 
     def _readNBytes(self, s, n, level):
         # lvl stp mask
         #  0   1    1 
         #  1   2    3 
         #  2   4   15 
+        #  3   8  255 (16 bit samples only)
         step = 2**level
         mask = (2**(2**level)) - 1
 
-        decoded = [0] * n
-        for byte in range(n):
-            for bit in range(8//step):
-                cur = ((s + byte) * (8//step)) + bit
+        symbols = self._getSubpixels(s * (8//step), (s + n) * (8//step)) & mask
 
-                i = cur // (self.height * 3)
-                j = (cur % (self.height * 3)) // 3
-                k = cur % 3
-                
-                decoded[byte] <<= step
-                decoded[byte] |= self.data[i,j,k] & mask
+        return bytearray(symbolsToBytes(symbols, level))
 
-        return bytearray(decoded)
+    def _readPackedBytes(self, s, n, level, lowSize=0):
+        # Payload bytes [s, s+n) (header included) of a layout with its first lowSize bytes at L0 and the rest
+        # at level: one vectorized read per part of the layout the range falls in
+        split = min(max(lowSize - s, 0), n)
+        if split == n:
+            return self._readNBytes(s, n, 0)
 
-    def __readNextNBytes(self, n, level):
-        if n < 1000: # Read single-threaded to avoid overhead
-            decoded = self._readNBytes(self._cur, n, level)
-        else:
-            threads = multiprocessing.cpu_count()
+        # Bytes after lowSize start right after its 8*lowSize subpixels, i.e. at byte lowSize * 2**level of level
+        upper = self._readNBytes(lowSize * 2**level + s + split - lowSize, n - split, level)
+        return self._readNBytes(s, split, 0) + upper if split else upper
 
-            # Split workload - each thread will read bytes indexed in range(s, e)
-            args = []
-            for t in range(threads):
-                s = t * (n//threads) + min(n%threads, t)
-                e = (t+1) * (n//threads) + min(n%threads, (t+1))
+    def _writePackedBytes(self, s, data, level, lowSize=0):
+        # Counterpart of _readPackedBytes()
+        split = min(max(lowSize - s, 0), len(data))
+        if split:
+            self._writeNBytes(s, data[:split], 0)
+        if split < len(data):
+            self._writeNBytes(lowSize * 2**level + s + split - lowSize, data[split:], level)
 
-                args.append((self._cur + s, e-s, level))
+    def _readsInParallel(self, n):
+        # Small reads, or ones with a single worker to do them, are faster in this process
+        return n >= PARALLEL_READ_THRESHOLD and (self.pool or getWorkerPool()).processes > 1
 
-            # Spawn parallel processes
-            pool = multiprocessing.Pool()
-            partsDecoded = pool.starmap(self._readNBytes, args)
-            pool.close()
-            pool.join()
+    def __readNextNBytes(self, n, header, stats=NO_STATS):
+        with stats.phase("extract", n):
+            if not self._readsInParallel(n): # Read single-threaded to avoid overhead
+                decoded = self._readPackedBytes(self._cur, n, header.level, header.lowSize)
+            else:
+                decoded = (self.pool or getWorkerPool()).readBytes(self, self._cur, n, header.level, stats, lowSize=header.lowSize)
 
-            # Join partial results in a big array
-            decoded = [i for t in partsDecoded for i in t]
+        self._cur += n
+        return decoded
+
+    def __readNextVerifiedBytes(self, n, header, stats=NO_STATS):
+        # __readNextNBytes() for ENCODING_CHUNKED payloads, reading whole chunks: each one is checked against
+        # its hash right after being decoded (by the worker that decoded it, when reading in parallel)
+        firstChunk = (self._cur - header.size) // header.chunkSize
+        chunkHashes = header.chunkHashes[firstChunk : firstChunk - (-n // header.chunkSize)]
+
+        if not self._readsInParallel(n):
+            with stats.phase("extract", n):
+                decoded = self._readPackedBytes(self._cur, n, header.level, header.lowSize)
+
+            with stats.phase("hash", n):
+                badChunk = _findBadChunk(decoded, chunkHashes, header.chunkSize, firstChunk)
+            if badChunk is not None:
+                raise ChunkIntegrityError(badChunk, header.chunkSize)
+        else:
+            with stats.phase("extract", n):
+                decoded = (self.pool or getWorkerPool()).readBytes(self, self._cur, n, header.level, stats, header.chunkSize, chunkHashes, firstChunk, header.lowSize)
 
         self._cur += n
-        return bytearray(decoded)
+        return decoded
 
-    def decodePayload(self, verbose=True):
-        payloadFilename, payloadLevel = self.hasPayload()
+    def decodePayload(self, verbose=True, header=None, stats=None):
+        # A header previously returned by readHeader() can be passed to skip reading it again
+        stats = stats or self.stats
 
-        if not payloadFilename:
-            raise ValueError("No payload found in '{}'.".format(self.filename))
+        if header is None:
+            header = self.readHeader()
 
-        if verbose: print("File '{}' found encoded as L{}!\nDecoding...".format(payloadFilename, payloadLevel))
+        if header is None:
+            raise ValueError("No payload found in '{}'.".format(self.filename))
 
-        self._cur = 0
+        if verbose: print("File '{}' found encoded as L{}!\nDecoding...".format(header.filename, header.level))
 
-        # Read payload header
         payload = Payload()
-        payload.encoding, payload.level, payload.filenameSize = self.__readNextNBytes(3, payloadLevel)
-        payload.filename = self.__readNextNBytes(payload.filenameSize, payloadLevel).decode("UTF-8")
-        hashRead = self.__readNextNBytes(hashlib.sha256().digest_size, payloadLevel)
-        payload.dataSize = int.from_bytes(self.__readNextNBytes(4, payloadLevel), byteorder="big", signed=False)
-        
+        payload.encoding, payload.level = header.encoding, header.level
+        payload.filename, payload.filenameSize = header.filename, header.filenameSize
+        payload.dataSize = header.dataSize
+        payload.chunkSize = None
+
         # Read data
-        payload.data = self.__readNextNBytes(payload.dataSize, payloadLevel)
-        assert hashRead == hashlib.sha256(payload.data).digest(), "Payload integrity check failed. File might be corrupted."
+        self._cur = header.size
+        if header.encoding & ENCODING_CHUNKED:
+            header.checkChunkHashes()
+            payload.chunkSize = header.chunkSize
+            payload.data = self.__readNextVerifiedBytes(payload.dataSize, header, stats)
+        else:
+            payload.data = self.__readNextNBytes(payload.dataSize, header, stats)
+
+            with stats.phase("hash", payload.dataSize):
+                dataHash = hashlib.sha256(payload.data).digest()
+            assert header.dataHash == dataHash, "Payload integrity check failed. File might be corrupted."
+
+        # The payload given back is the original one, uncompressed
+        if header.encoding & ENCODING_COMPRESSED:
+            frames = []
+            decompressor = _FrameDecompressor(frames.append, header.compressionMethod, stats)
+            decompressor.write(payload.data)
+            decompressor.close(header.originalSize)
+
+            payload.data = b"".join(frames)
+            payload.encoding &= ~ENCODING_COMPRESSED
+            payload.dataSize = header.originalSize
 
         return payload
 
-    def encodePayload(self, payload, fillRandom=False, verbose=True):
+    def decodePayloadTo(self, fileobj, chunkSize=CHUNK_SIZE, verbose=True, header=None, stats=None):
+        # Streams the payload data to fileobj (anything with a write() method) chunkSize bytes at a time,
+        # hashing as it goes, so memory use doesn't grow with the payload size
+        stats = stats or self.stats
+
+        if header is None:
+            header = self.readHeader()
+
+        if header is None:
+            raise ValueError("No payload found in '{}'.".format(self.filename))
+
+        if verbose: print("File '{}' found encoded as L{}!\nDecoding...".format(header.filename, header.level))
+
+        def write(chunk):
+            with stats.phase("write", len(chunk)):
+                fileobj.write(chunk)
+
+        # Compressed payloads are decompressed frame by frame on their way to fileobj
+        decompressor = None
+        if header.encoding & ENCODING_COMPRESSED:
+            decompressor = _FrameDecompressor(write, header.compressionMethod, stats)
+            write = decompressor.write
+
+        self._cur = header.size
+        if header.encoding & ENCODING_CHUNKED:
+            # Whole chunks at a time, each one verified before being written
+            header.checkChunkHashes()
+            chunkSize = max(chunkSize // header.chunkSize, 1) * header.chunkSize
+
+            for s in range(0, header.dataSize, chunkSize):
+                write(self.__readNextVerifiedBytes(min(chunkSize, header.dataSize - s), header, stats))
+
+            if decompressor is not None:
+                decompressor.close(header.originalSize)
+
+            return header
+
+        dataHash = hashlib.sha256()
+        for s in range(0, header.dataSize, chunkSize):
+            chunk = self.__readNextNBytes(min(chunkSize, header.dataSize - s), header, stats)
+
+            with stats.phase("hash", len(chunk)):
+                dataHash.update(chunk)
+            write(chunk)
+
+        assert header.dataHash == dataHash.digest(), "Payload integrity check failed. File might be corrupted."
+
+        if decompressor is not None:
+            decompressor.close(header.originalSize)
+
+        return header
+
+    def getPayloadLevel(self, packedSize):
+        # Lowest level that fits packedSize bytes, or None if none does
+        for level, storage in enumerate(self.storages):
+            if packedSize <= storage:
+                return level
+
+        return None
+
+    def getMixedLayout(self, packedSize):
+        # (level, lowSize) of a mixed layout for packedSize bytes (its low-size field included): as many bytes as
+        # possible at L0 and the rest at the lowest level that fits them. None if it wouldn't fit, or fits at L0 already
+        level = self.getPayloadLevel(packedSize)
+        if not level:
+            return None
+
+        # 8 subpixels per L0 byte and perByte per byte of the rest, within every subpixel of the image
+        perByte = 8 // 2**level
+        return level, (self.subpixels - packedSize * perByte) // (8 - perByte)
+
+    def encodePayload(self, payload, fillRandom=False, verbose=True, stats=None, mixed=False):
+        # With mixed, payloads that don't fit at L0 only have what doesn't fit at a higher level (ENCODING_MIXED)
+        stats = stats or self.stats
         packedSize = payload.getPackedSize()
 
-        if packedSize > self.storageL2:
+        payloadLevel = self.getPayloadLevel(packedSize)
+        if payloadLevel is None:
             raise ValueError("Payload '{}' too big to encode into '{}'.".format(payload.filename, self.filename))
 
-        if packedSize <= self.storageL0:
-            payloadLevel = 0
-        elif packedSize <= self.storageL1:
-            payloadLevel = 1
-        else:
-            payloadLevel = 2
+        # The header has to fit in the L0 part, and the low-size field mustn't push the rest up a level: a payload
+        # that only fits at payloadLevel without it is left plain
+        lowSize = None
+        layout = self.getMixedLayout(packedSize + MIXED_FIELDS_SIZE) if mixed and payloadLevel else None
+        if layout is not None and layout[0] == payloadLevel and layout[1] >= payload.getHeaderSize() + MIXED_FIELDS_SIZE:
+            payloadLevel, lowSize = layout
+            packedSize += MIXED_FIELDS_SIZE
 
-        packedPayload = payload.getBytes(payloadLevel)
+        stats.level = payloadLevel
 
-        if verbose: print("Encoding '{}' into '{}' using L{}...".format(payload.filename, self.filename, payloadLevel))
+        if verbose: print("Encoding '{}' into '{}' using {}...".format(payload.filename, self.filename, "L0/L{}".format(payloadLevel) if lowSize else "L{}".format(payloadLevel)))
 
         # lvl stp mask
         #  0   1    1
         #  1   2    3
         #  2   4   15
+        #  3   8  255 (16 bit samples only)
         step = 2**payloadLevel
         mask = (2**(2**payloadLevel)) - 1
 
-        # Convert payload to a matrix format to allow for NumPy's vectorization
-        if fillRandom: # Fill remaining pixels with random noise 
-            payloadMatrix = np.random.randint(0, mask+1, (self.width, self.height, 3), dtype=np.uint8)
+        # Stream the data in after the header, hashing it on the way
+        header = payload.getHeaderBytes(payloadLevel, lowSize=lowSize)
+        self._writePackedBytes(0, header, payloadLevel, lowSize or 0)
+
+        # Chunked payloads are streamed in whole chunks, so every one can be hashed on its own
+        chunked = payload.encoding & ENCODING_CHUNKED
+        streamSize = max(CHUNK_SIZE // payload.chunkSize, 1) * payload.chunkSize if chunked else CHUNK_SIZE
+
+        cur = len(header)
+        dataHash, chunkHashes = hashlib.sha256(), []
+        chunks = payload.iterChunks(streamSize)
+        while True:
+            with stats.phase("read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+
+            with stats.phase("hash", len(chunk)):
+                if chunked:
+                    chunkHashes += hashChunks(chunk, payload.chunkSize)
+                else:
+                    dataHash.update(chunk)
+            with stats.phase("embed", len(chunk)):
+                self._writePackedBytes(cur, chunk, payloadLevel, lowSize or 0)
+            cur += len(chunk)
+
+        if cur != packedSize:
+            raise ValueError("Payload '{}' changed size while being encoded.".format(payload.filename))
+
+        # Fill in the hash slots left zeroed in the header
+        if chunked:
+            header = payload.getHeaderBytes(payloadLevel, merkleRoot(chunkHashes), chunkHashes, lowSize)
         else:
-            payloadMatrix = self.data.copy()
+            header = payload.getHeaderBytes(payloadLevel, dataHash.digest(), lowSize=lowSize)
+        self._writePackedBytes(0, header, payloadLevel, lowSize or 0)
 
-        for byte in range(len(packedPayload)):
-            cur = byte * (8 // step)
-            
-            # 0: [7, 6, 5, 4, 3, 2, 1, 0], 1: [6, 4, 2, 0], 2: [4, 0]
-            for bit in range(8-step, -1, -step):
-                i = cur // (self.height * 3)
-                j = (cur % (self.height * 3)) // 3
-                k = cur % 3
+        if fillRandom: # Fill remaining pixels with random noise
+            used = packedSize * (8//step) + (lowSize or 0) * (8 - 8//step)
+            self._writeSubpixels(used, np.random.randint(0, mask+1, self.subpixels - used, dtype=self.data.dtype), mask)
 
-                payloadMatrix[i,j,k] = (packedPayload[byte] >> bit) & mask
+        return self.data
 
-                cur += 1
+class PayloadHeader:
+    def __init__(self, encoding, level, filename, dataHash, dataSize):
+        self.encoding = encoding
+        self.level = level
+        self.filename = filename
+        self.filenameSize = len(filename)
+        self.dataHash = dataHash
+        self.dataSize = dataSize
 
-        # Replace last bits of every subpixel
-        self.data &= 0b11111111 - mask
-        self.data |= payloadMatrix
+        # Header size in bytes, i.e. where the payload data starts
+        self.size = 3 + len(filename.encode("UTF-8")) + len(dataHash) + 4
 
-        return self.data
+        # Bytes at L0 before those at `level` (ENCODING_MIXED), none otherwise
+        self.lowSize = 0
+
+        # Image the header was read from (set by Image.readHeader()), for readRange()
+        self.image = None
+
+    def __getstate__(self):
+        # Headers are sent back from workers, their image stays behind
+        state = self.__dict__.copy()
+        state["image"] = None
+        return state
+
+    def getSubpixelRange(self, offset, length):
+        # Subpixels [s, e) holding payload data bytes [offset, offset+length).
+        # (see Image._getSubpixels() for where subpixel cur is)
+        if offset < 0 or length < 0 or offset + length > self.dataSize:
+            raise ValueError("Range [{}, {}) is outside of '{}' ({} bytes).".format(offset, offset + length, self.filename, self.dataSize))
+
+        def subpixel(cur):
+            # The first lowSize bytes take 8 subpixels each, the rest 8 // 2**level
+            return cur * 8 - max(cur - self.lowSize, 0) * (8 - 8 // 2**self.level)
+
+        return subpixel(self.size + offset), subpixel(self.size + offset + length)
+
+    def readRange(self, offset, length):
+        # Decodes only payload data bytes [offset, offset+length), touching only the subpixels holding them.
+        # ENCODING_CHUNKED payloads are read in the whole chunks covering the range, each checked against its hash
+        self.getSubpixelRange(offset, length)
+
+        if self.encoding & ENCODING_COMPRESSED:
+            raise ValueError("Can't read a range of '{}', as it's stored compressed.".format(self.filename))
+
+        # Nothing to read (an empty read would be addressed at L0, past the end of the image for payloads near it)
+        if length == 0:
+            return bytearray()
+
+        if not self.encoding & ENCODING_CHUNKED:
+            return self.image._readPackedBytes(self.size + offset, length, self.level, self.lowSize)
+
+        self.checkChunkHashes()
+        firstChunk = offset // self.chunkSize
+        lastChunk = -(-(offset + length) // self.chunkSize)
+
+        s = firstChunk * self.chunkSize
+        data = self.image._readPackedBytes(self.size + s, min(lastChunk * self.chunkSize, self.dataSize) - s, self.level, self.lowSize)
+
+        badChunk = _findBadChunk(data, self.chunkHashes[firstChunk:lastChunk], self.chunkSize, firstChunk)
+        if badChunk is not None:
+            raise ChunkIntegrityError(badChunk, self.chunkSize)
+
+        return data[offset - s : offset - s + length]
+
+    def setShardFields(self, fields):
+        self.shardIndex = int.from_bytes(fields[0:2], byteorder="big", signed=False)
+        self.shardCount = int.from_bytes(fields[2:4], byteorder="big", signed=False)
+        self.shardOffset = int.from_bytes(fields[4:12], byteorder="big", signed=False)
+        self.totalSize = int.from_bytes(fields[12:20], byteorder="big", signed=False)
+        self.totalHash = bytes(fields[20:52])
+
+        self.size += SHARD_FIELDS_SIZE
+
+    def setChunkFields(self, chunkSize, chunkHashes):
+        self.chunkSize = chunkSize
+        self.chunkHashes = [bytes(chunkHashes[i:i+32]) for i in range(0, len(chunkHashes), 32)]
+
+        self.size += 4 + len(chunkHashes)
+
+    def setCompressionFields(self, fields):
+        self.compressionMethod = getPayloadCompressor(fields[0])
+        self.originalSize = int.from_bytes(fields[1:9], byteorder="big", signed=False)
+
+        self.size += COMPRESSION_FIELDS_SIZE
+
+    def setMixedFields(self, fields):
+        self.lowSize = int.from_bytes(fields[0:8], byteorder="big", signed=False)
+
+        self.size += MIXED_FIELDS_SIZE
+
+    def checkChunkHashes(self):
+        # The chunk hashes are only trusted once they add up to the data-hash
+        assert merkleRoot(self.chunkHashes) == self.dataHash, "Payload integrity check failed. File might be corrupted."
 
 class Payload:
-    def __init__(self, filename=None):
-        if filename:
-            self.filename = os.path.split(filename)[-1]
+    def __init__(self, source=None, name=None, chunkSize=None):
+        # source can be a path or a binary file object, whose data is only read while encoding, chunk by chunk,
+        # so the payload never has to fit in memory. It can also be the data itself (bytes, bytearray or
+        # memoryview), which is used without copying.
+        # With chunkSize, the data is hashed in chunks of that size (ENCODING_CHUNKED), so it can be verified
+        # chunk by chunk, in parallel, while decoding
+        self._source = source
+        self._data = None
+
+        if source is not None:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                self._data = memoryview(source).cast("B")
+                self.filename = name or "payload"
+                self.dataSize = self._data.nbytes
+            elif isinstance(source, (str, os.PathLike)):
+                self.filename = os.path.split(source)[-1]
+                self.dataSize = os.stat(source).st_size
+            else:
+                self.filename = os.path.split(name or getattr(source, "name", "payload"))[-1]
+                self._start = source.tell()
+                try:
+                    self.dataSize = os.fstat(source.fileno()).st_size - self._start
+                except (AttributeError, OSError): # Not backed by a real file
+                    self.dataSize = source.seek(0, os.SEEK_END) - self._start
+                    source.seek(self._start)
+
+            if name is not None:
+                self.filename = name
 
             if len(self.filename) > 255:
                 raise ValueError("Payload filename is too long! (Max 255, is {})".format(len(self.filename)))
 
-            self.data = loadBinaryFile(filename)
+            if chunkSize and not 0 < chunkSize <= MAX_HASH_CHUNK_SIZE:
+                raise ValueError("Chunk size must be between 1 and {} bytes! (Is {})".format(MAX_HASH_CHUNK_SIZE, chunkSize))
 
-            self.encoding = 0
+            self.encoding = ENCODING_CHUNKED if chunkSize else 0
+            self.chunkSize = chunkSize
             self.filenameSize = len(self.filename)
-            self.dataSize = len(self.data)
+            self._offset = 0
+
+    @property
+    def data(self):
+        # Only loaded into memory when actually asked for
+        if self._data is None and self._source is not None:
+            self._data = b"".join(self.iterChunks())
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def iterChunks(self, chunkSize=CHUNK_SIZE):
+        if self._data is not None or self._source is None:
+            for s in range(0, len(self.data), chunkSize):
+                yield self.data[s:s+chunkSize]
+
+        elif isinstance(self._source, Payload): # Shard, see getShard()
+            yield from self._source._iterRange(self._offset, self.dataSize, chunkSize)
+
+        else:
+            yield from self._iterRange(0, self.dataSize, chunkSize)
+
+    def _iterRange(self, offset, size, chunkSize):
+        if self._data is not None:
+            for s in range(offset, offset + size, chunkSize):
+                yield self.data[s:min(s + chunkSize, offset + size)]
+            return
+
+        if isinstance(self._source, (str, os.PathLike)):
+            f = open(self._source, "rb")
+        else:
+            f = self._source
+            offset += self._start
+
+        try:
+            f.seek(offset)
+            while size > 0:
+                chunk = f.read(min(chunkSize, size))
+                if not chunk:
+                    break
+
+                size -= len(chunk)
+                yield chunk
+        finally:
+            if f is not self._source:
+                f.close()
+
+    def getHash(self):
+        # SHA-256 of the data, computed with a streaming pass over it
+        dataHash = hashlib.sha256()
+        for chunk in self.iterChunks():
+            dataHash.update(chunk)
+
+        return dataHash.digest()
+
+    def compress(self, method="zlib", level=6, threads=None):
+        # Returns a new payload (ENCODING_COMPRESSED) holding this one's data compressed with method, in frames
+        # of COMPRESSION_FRAME_SIZE bytes compressed on `threads` threads (default: all cores), or this same
+        # payload if compressing doesn't make it any smaller. Method "auto" tries every method in
+        # PAYLOAD_COMPRESSORS on the first frame and keeps the one that did best
+        frames = self.iterChunks(COMPRESSION_FRAME_SIZE)
+        first = next(frames, None)
+        if first is None:
+            return self
+
+        trials = {}
+        if method == "auto":
+            trials = {name: compressor[1](first, level) for name, compressor in PAYLOAD_COMPRESSORS.items()}
+            method = min(trials, key=lambda name: len(trials[name]))
+
+        compress = PAYLOAD_COMPRESSORS[method][1]
+        threads = threads or os.cpu_count() or 1
+
+        # compressed-size (4B) + compressed data, per frame. At most 2 frames per thread are in flight,
+        # and it's given up on as soon as the output gets bigger than the data
+        data = bytearray()
+        with futures.ThreadPoolExecutor(threads) as executor:
+            pending = collections.deque([executor.submit(lambda: trials.get(method) or compress(first, level))])
+
+            for frame in frames:
+                pending.append(executor.submit(compress, frame, level))
+
+                if len(pending) > 2 * threads:
+                    frame = pending.popleft().result()
+                    data += len(frame).to_bytes(4, byteorder="big", signed=False) + frame
+
+                    if len(data) >= self.dataSize:
+                        for future in pending:
+                            future.cancel()
+                        return self
+
+            for future in pending:
+                frame = future.result()
+                data += len(frame).to_bytes(4, byteorder="big", signed=False) + frame
+
+        if len(data) >= self.dataSize:
+            return self
+
+        compressed = Payload(data, name=self.filename, chunkSize=self.chunkSize)
+        compressed.encoding |= self.encoding | ENCODING_COMPRESSED
+        compressed.compressionMethod, compressed.originalSize = method, self.dataSize
+
+        return compressed
+
+    def getShard(self, index, count, offset, size, totalHash):
+        # Payload holding data bytes [offset, offset+size), to be encoded as shard index (of count) into its own image
+        if self.encoding & ENCODING_COMPRESSED:
+            raise ValueError("Compressed payloads can't be split across images.")
+
+        shard = Payload()
+        shard._source, shard._data, shard._offset = self, None, offset
+        shard.filename, shard.filenameSize = self.filename, self.filenameSize
+        shard.dataSize = size
+
+        shard.encoding, shard.chunkSize = self.encoding | ENCODING_SHARDED, self.chunkSize
+        shard.shardIndex, shard.shardCount, shard.shardOffset = index, count, offset
+        shard.totalSize, shard.totalHash = self.dataSize, totalHash
+
+        return shard
 
     def saveFile(self, path=""):
-        saveBinaryFile(self.data, os.path.join(path, self.filename))
+        # path can also be a binary file object to write the data to
+        if hasattr(path, "write"):
+            path.write(self.data)
+        else:
+            saveBinaryFile(self.data, os.path.join(path, self.filename))
 
     def getPackedSize(self):
-        return 3 + self.filenameSize + hashlib.sha256().digest_size + 4 + self.dataSize
+        return self.getHeaderSize() + self.dataSize
+
+    def getHeaderSize(self):
+        size = 3 + len(self.filename.encode("UTF-8")) + hashlib.sha256().digest_size + 4
+
+        if self.encoding & ENCODING_SHARDED:
+            size += SHARD_FIELDS_SIZE
+
+        if self.encoding & ENCODING_CHUNKED:
+            size += 4 + hashlib.sha256().digest_size * -(-self.dataSize // self.chunkSize)
+
+        if self.encoding & ENCODING_COMPRESSED:
+            size += COMPRESSION_FIELDS_SIZE
+
+        return size
 
     def printInfo(self):
         print("'{}' needs {} of payload storage.".format(self.filename, formatBytes(self.getPackedSize())))
 
-    def getBytes(self, payloadLevel):
+    def getHeaderBytes(self, payloadLevel, dataHash=None, chunkHashes=None, lowSize=None):
         # Encoding payload header (at least 40 bytes)
 
         # encoding + level + filename-size + FILENAME + data-hash + data-size
         #    1B    +   1B  +       1B      + [1-255]B +    32B    +     4B   
 
-        header = bytearray([self.encoding, payloadLevel, self.filenameSize])
+        # Without a dataHash (or chunkHashes), the slots are left zeroed to be filled in once the data has been streamed
+        if dataHash is None:
+            dataHash = bytes(hashlib.sha256().digest_size)
+
+        # A lowSize (set by Image.encodePayload() for a mixed layout) adds the ENCODING_MIXED fields
+        encoding = self.encoding | (ENCODING_MIXED if lowSize is not None else 0)
+
+        header = bytearray([encoding, payloadLevel, self.filenameSize])
         header += bytearray(self.filename, "UTF-8")
-        header += hashlib.sha256(self.data).digest()
+        header += dataHash
         header += self.dataSize.to_bytes(4, byteorder="big", signed=False)
 
-        return header + self.data
+        # shard-index + shard-count + shard-offset + total-size + total-hash
+        #     2B      +     2B      +      8B      +     8B     +    32B
+        if self.encoding & ENCODING_SHARDED:
+            header += self.shardIndex.to_bytes(2, byteorder="big", signed=False)
+            header += self.shardCount.to_bytes(2, byteorder="big", signed=False)
+            header += self.shardOffset.to_bytes(8, byteorder="big", signed=False)
+            header += self.totalSize.to_bytes(8, byteorder="big", signed=False)
+            header += self.totalHash
+
+        # chunk-size + chunk-hashes
+        #     4B     + 32B * ceil(data-size / chunk-size)
+        if self.encoding & ENCODING_CHUNKED:
+            header += self.chunkSize.to_bytes(4, byteorder="big", signed=False)
+            header += b"".join(chunkHashes) if chunkHashes is not None else bytes(hashlib.sha256().digest_size * -(-self.dataSize // self.chunkSize))
+
+        # compression-method + original-size
+        #         1B         +      8B
+        if self.encoding & ENCODING_COMPRESSED:
+            header += bytes([PAYLOAD_COMPRESSORS[self.compressionMethod][0]])
+            header += self.originalSize.to_bytes(8, byteorder="big", signed=False)
+
+        # low-size
+        #    8B
+        if lowSize is not None:
+            header += lowSize.to_bytes(8, byteorder="big", signed=False)
+
+        return header
 
-# Standalone execution
-if __name__ == "__main__":
-    from time import time
-    from sys import argv
+    def getBytes(self, payloadLevel):
+        if self.encoding & ENCODING_CHUNKED:
+            chunkHashes = hashChunks(self.data, self.chunkSize)
+            return self.getHeaderBytes(payloadLevel, merkleRoot(chunkHashes), chunkHashes) + self.data
+
+        return self.getHeaderBytes(payloadLevel, hashlib.sha256(self.data).digest()) + self.data
+
+# Capacity planning
+
+# Expected squared error of each touched subpixel, per level: taking both the replaced and the new k bits
+# as uniformly random, E[(a-b)^2] = 2 * Var = (4^k - 1) / 6, i.e. 0.5, 2.5, 42.5 and 10922.5 (L3, 16 bit only)
+LEVEL_MSE = [(4**(2**level) - 1) / 6 for level in [0, 1, 2, 3]]
+
+def getStorages(pixels, planes=3, sampleBits=8):
+    # Payload storage capacities at every level of images with that many pixels (an int or an array of them), of
+    # planes channels carrying the payload. A level takes at most half the bits of a sample: L0 to L2 for
+    # 8 bit samples, up to L3 (8 bits) for 16 bit ones
+    return [(pixels * planes) * 2**level // 8 for level in range((sampleBits // 2).bit_length())]
+
+def readImageShape(filename):
+    # (width, height, channels) of an image, width being the amount of rows as in Image, read from the file
+    # header only for raw pixel caches, PNG (IHDR), JPEG (SOFn) and BMP. Anything else is fully decoded
+    return readImageFormat(filename)[0]
+
+def readImageFormat(filename):
+    # (readImageShape(), bits per sample) of an image, the way Image would load it
+    with open(filename, "rb") as f:
+        head = f.read(RAW_HEADER_SIZE)
+
+        if head[:len(RAW_MAGIC)] == RAW_MAGIC:
+            shape, dtype = _parseRawHeader(head, filename)
+            return shape, 8 * dtype.itemsize
+
+        if head[:8] == PNG_SIGNATURE and head[12:16] == b"IHDR":
+            columns, rows = struct.unpack(">II", head[16:24])
+            channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}[head[25]]
+            return (rows, columns, channels), 16 if head[24] == 16 and channels >= 3 else 8
+
+        if head[:2] == b"BM":
+            columns, rows = struct.unpack("<ii", head[18:26])
+            return (abs(rows), columns, 3), 8
+
+        if head[:2] == b"\xff\xd8":
+            # Walk the marker segments up to the frame header (any SOFn but DHT, JPG and DAC)
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    break
+
+                if marker[1] in (0x01, 0xFF) or 0xD0 <= marker[1] <= 0xD8:
+                    f.seek(-1 if marker[1] == 0xFF else 0, os.SEEK_CUR)
+                    continue
+
+                length = int.from_bytes(f.read(2), byteorder="big")
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    _, rows, columns, components = struct.unpack(">BHHB", f.read(6))
+                    return (rows, columns, components), 8
+
+                f.seek(length - 2, os.SEEK_CUR)
+
+    data = Image(filename).data
+    return data.shape, 8 * data.dtype.itemsize
+
+def printImageInfo(filename, channelSet=None):
+    # Image.printInfo() from the file header alone (see readImageFormat()), without decoding the image
+    (rows, columns, channels), sampleBits = readImageFormat(filename)
+    planes = len(_parseChannelSet(channelSet))
+
+    _printInfo(filename, getsize(filename), rows, columns, sampleBits, getStorages(rows * columns, planes, sampleBits))
+
+def _printInfo(filename, dataSize, width, height, sampleBits, storages):
+    print("'{}' has file size {} and".format(filename, formatBytes(dataSize)), end=" ")
+    print("dimensions {}x{} ({} pixels, {} bit).".format(width, height, width * height, sampleBits))
+
+    print("Payload storage capacities (including payload header):")
+    print("  Level 0: up to {}".format(formatBytes(storages[0])))
+    for level in range(1, len(storages)):
+        print("  Level {}: {} to {}".format(level, formatBytes(storages[level-1]+1), formatBytes(storages[level])))
+
+def planCapacities(imageFilenames, payloads, channelSet=None):
+    # Vectorized planCapacity() of every payload (a Payload, or a path that is only stat'ed) into every image.
+    # Returns (levels, subpixels, psnr) arrays of shape (len(payloads), len(imageFilenames)), with
+    # level -1 and PSNR NaN where the payload doesn't fit
+    channelSet = _parseChannelSet(channelSet)
+    formats = [readImageFormat(imageFilename) for imageFilename in imageFilenames]
+
+    # Images Image() wouldn't take with this channel set hold nothing
+    pixels = np.array([rows * columns if channels >= 3 and max(channelSet) < channels else 0 for (rows, columns, channels), _ in formats], dtype=np.int64)
+    sampleBits = np.array([bits for _, bits in formats], dtype=np.int64)
+
+    payloads = [payload if isinstance(payload, Payload) else Payload(payload) for payload in payloads]
+    packedSizes = np.array([payload.getPackedSize() for payload in payloads], dtype=np.int64)
+
+    # Capacity of every level, up to L3 for 16 bit images and L2 for 8 bit ones (see getStorages())
+    storages = np.stack(getStorages(pixels, len(channelSet), 16), axis=-1)
+    levelCounts = np.array([len(getStorages(0, 1, bits)) for _, bits in formats], dtype=np.int64)
+    storages[np.arange(storages.shape[1]) >= levelCounts[:, None]] = -1
+
+    # Lowest level fitting each payload into each image
+    fits = packedSizes[:, None, None] <= storages[None, :, :]
+    levels = np.where(fits.any(axis=2), fits.argmax(axis=2), -1)
+
+    fitting = levels >= 0
+    subpixels = np.where(fitting, packedSizes[:, None] * (8 // 2**np.maximum(levels, 0)), 0)
+
+    # The distortion of the touched subpixels, spread over all subpixels of the channel set, against the
+    # peak value of the image's samples
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mse = subpixels * np.array(LEVEL_MSE)[np.maximum(levels, 0)] / (pixels * len(channelSet))
+        psnr = np.where(fitting, 10 * np.log10((2.0**sampleBits - 1)**2 / mse), np.nan)
+
+    return levels, subpixels, psnr
+
+def planCapacity(imageFilename, payload, channelSet=None):
+    # Level, amount of subpixels touched and expected PSNR (dB, over the channels in channelSet) of encoding
+    # payload into imageFilename, without decoding the image or reading the payload data. Level is None if it doesn't fit
+    levels, subpixels, psnr = planCapacities([imageFilename], [payload], channelSet)
+
+    if levels[0, 0] < 0:
+        return {"level": None, "subpixels": 0, "psnr": None}
+
+    return {"level": int(levels[0, 0]), "subpixels": int(subpixels[0, 0]), "psnr": float(psnr[0, 0])}
+
+def rankCovers(imageFilenames, payloads, channelSet=None):
+    # For every payload, the indexes of the images it fits into, least distorted (highest PSNR) first
+    levels, _, psnr = planCapacities(imageFilenames, payloads, channelSet)
+    order = np.argsort(-np.nan_to_num(psnr, nan=-np.inf), axis=1, kind="stable")
+
+    return [[int(i) for i in row if fitting[i]] for row, fitting in zip(order, levels >= 0)]
+
+# Steganalysis
+
+# Growing prefixes of the image checked by the chi-square attack, as sequential embedding starts at the first pixel
+CHI_SQUARE_SEGMENTS = 32
+
+# Subpixels (in evenly spaced rows) RS analysis looks at, bounding its time on big images
+RS_SAMPLE_SIZE = 1 << 21
+
+# Score from which an image without a StegoPack header is reported as suspicious
+SUSPICION_THRESHOLD = 0.5
+
+def _chiSquareSurvival(x, dof):
+    # P(X >= x) for X ~ chi-square(dof) (Wilson-Hilferty approximation), for arrays of x and dof
+    dof = np.maximum(dof, 1)
+    z = (np.cbrt(x / dof) - (1 - 2 / (9*dof))) / np.sqrt(2 / (9*dof))
+    return np.array([0.5 * math.erfc(v / math.sqrt(2)) for v in np.ravel(z)]).reshape(np.shape(z))
+
+def chiSquareAttack(histograms):
+    # Westfeld & Pfitzmann's chi-square attack: LSB embedding evens out the counts of every pair of values (2i, 2i+1).
+    # Takes the (prefixes, 256) histograms of growing prefixes of the subpixels and returns the probability of
+    # each prefix being embedded (the p-value of its pairs being as even as they are)
+    even, odd = histograms[:, 0::2].astype(np.float64), histograms[:, 1::2].astype(np.float64)
+    expected = (even + odd) / 2
+
+    # Pairs with too few samples are left out, as usual for chi-square tests
+    valid = expected > 4
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi = np.where(valid, (even - expected)**2 / expected, 0).sum(axis=1)
+
+    return np.where(valid.sum(axis=1) > 1, _chiSquareSurvival(chi, valid.sum(axis=1) - 1), 0)
+
+def _rsCounts(a, b, c, d):
+    # Fractions of regular and singular groups (a, b, c, d) under the flipping mask [0, 1, 1, 0] and its negative
+    f = np.abs(b - a) + np.abs(c - b) + np.abs(d - c)
+
+    bm, cm = b ^ 1, c ^ 1
+    fm = np.abs(bm - a) + np.abs(cm - bm) + np.abs(d - cm)
+
+    bn, cn = ((b + 1) ^ 1) - 1, ((c + 1) ^ 1) - 1 # Shifted flipping: -1 <-> 0, 1 <-> 2, ...
+    fn = np.abs(bn - a) + np.abs(cn - bn) + np.abs(d - cn)
+
+    return np.count_nonzero(fm > f) / f.size, np.count_nonzero(fm < f) / f.size, np.count_nonzero(fn > f) / f.size, np.count_nonzero(fn < f) / f.size
+
+def rsAnalysis(pixels):
+    # Fridrich's RS analysis over groups of 4 horizontally adjacent subpixels of every channel (alpha ignored).
+    # Returns the estimated fraction of subpixels carrying a payload in their LSB
+    groupColumns = pixels.shape[1] // 4
+    if groupColumns == 0 or pixels.shape[0] == 0:
+        return 0.0
+
+    # One array per position in the group, rather than gathering the groups themselves
+    signed = np.int16 if pixels.dtype.itemsize == 1 else np.int32
+    planes = [pixels[:, i:groupColumns*4:4, :3].astype(signed) for i in range(4)]
+
+    rm, sm, rn, sn = _rsCounts(*planes)
+    rm1, sm1, rn1, sn1 = _rsCounts(*[plane ^ 1 for plane in planes])
+
+    # 2(d1 + d0)x^2 + (d-0 - d-1 - d1 - 3d0)x + d0 - d-0 = 0, with its smallest root giving the length
+    d0, d1, dn0, dn1 = rm - sm, rm1 - sm1, rn - sn, rn1 - sn1
+    a, b, c = 2 * (d1 + d0), dn0 - dn1 - d1 - 3 * d0, d0 - dn0
+
+    if a == 0:
+        x = -c / b if b else 0.0
+    else:
+        discriminant = b*b - 4*a*c
+        if discriminant < 0:
+            return 0.0
+        x = min([(-b + math.sqrt(discriminant)) / (2*a), (-b - math.sqrt(discriminant)) / (2*a)], key=abs)
+
+    return float(min(max(x / (x - 0.5), 0.0), 1.0)) if x != 0.5 else 1.0
+
+def analyzeImage(image):
+    # Statistical LSB steganalysis of an Image (or an image filename): the chi-square attack over growing
+    # prefixes, RS analysis and the entropy of every bit plane, all on whole arrays at once. The suspicion
+    # score is the highest of the chi-square probabilities and the RS estimate
+    if not isinstance(image, Image):
+        image = Image(image)
+
+    rows, columns = image.width, image.height
+    subpixels = image.data[:, :, :3].reshape(-1)
+
+    # One histogram per segment, accumulated into those of growing prefixes
+    segments = np.array_split(subpixels, CHI_SQUARE_SEGMENTS)
+    histograms = np.cumsum([np.bincount(segment, minlength=1 << image.sampleBits) for segment in segments], axis=0)
+    chiSquare = chiSquareAttack(histograms)
+
+    # Fraction of the image covered by the leading prefixes that look embedded
+    embedded = np.flatnonzero(chiSquare <= 0.5)
+    chiSquareLength = (embedded[0] if len(embedded) else CHI_SQUARE_SEGMENTS) / CHI_SQUARE_SEGMENTS
+
+    rowStep = max(rows * columns * 3 // RS_SAMPLE_SIZE, 1)
+    rsLength = rsAnalysis(image.data[::rowStep])
+
+    # Share of 1s in every bit plane, straight from the histogram of the whole image
+    values = np.arange(histograms.shape[1])
+    ones = np.array([histograms[-1][(values >> bit) & 1 == 1].sum() for bit in range(image.sampleBits)]) / max(len(subpixels), 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = np.nan_to_num(-(ones * np.log2(ones) + (1 - ones) * np.log2(1 - ones)))
+
+    return {
+        "width": columns, "height": rows,
+        "score": round(max(float(chiSquare.max()), rsLength), 4),
+        "chiSquare": round(float(chiSquare.max()), 4),
+        "chiSquareLength": round(float(chiSquareLength), 4),
+        "rsLength": round(rsLength, 4),
+        "lsbEntropy": round(float(entropy[0]), 4),
+        "bitPlaneEntropy": [round(float(e), 4) for e in entropy],
+    }
+
+# Sharding across multiple images
+
+def planShards(dataSize, headerSize, storages):
+    # Splits dataSize bytes across covers with the given capacities at every level (see getStorages(), up to L3
+    # for 16 bit covers), keeping the highest level used as low as possible. Returns (coverIndex, offset, size, level) shards
+    def capacity(storage, level):
+        # Covers without that level hold what their highest one does
+        return max(storage[min(level, len(storage) - 1)] - headerSize, 0)
+
+    for maxLevel in range(max(map(len, storages), default=0)):
+        capacities = [capacity(storage, maxLevel) for storage in storages]
+        if sum(capacities) >= dataSize:
+            break
+    else:
+        raise ValueError("Payload too big to encode into the {} given images.".format(len(storages)))
+
+    # Every cover holds what it can one level below (which falls short, or maxLevel would be lower), and only
+    # as many covers as needed go up to maxLevel, starting with those that gain the most from it
+    sizes = [capacity(storage, maxLevel-1) if maxLevel else 0 for storage in storages]
+    remaining = dataSize - sum(sizes)
+
+    for i in sorted(range(len(storages)), key=lambda i: capacities[i] - sizes[i], reverse=True):
+        if remaining <= 0:
+            break
+
+        extra = min(capacities[i] - sizes[i], remaining)
+        sizes[i] += extra
+        remaining -= extra
+
+    shards, offset = [], 0
+    for i, size in enumerate(sizes):
+        if size > 0:
+            level = next(level for level, storage in enumerate(storages[i]) if size + headerSize <= storage)
+            shards.append((i, offset, size, level))
+            offset += size
+
+    return shards
+
+def _storageJob(job):
+    # Image.storages of an image carrying the payload in channelSet, from its file header alone (see readImageFormat())
+    imageFilename, channelSet = job
+    (rows, columns, channels), sampleBits = readImageFormat(imageFilename)
+
+    if channels < 3 or max(channelSet) >= channels:
+        raise ValueError("Channel set {} doesn't fit the {} channels of '{}'.".format(channelSet, channels, imageFilename))
+
+    return getStorages(rows * columns, len(channelSet), sampleBits)
+
+def _encodeShardJob(job):
+    imageFilename, shard, outputFilename, channelSet = job
+
+    image = Image(imageFilename, channelSet=channelSet)
+    image.encodePayload(shard, verbose=False)
+    return image.saveFile(outputFilename)
+
+def _newShardFile(outputPath):
+    # Temporary file in outputPath the shards of a payload are decoded into, until _joinShards() checked it
+    filename = os.path.join(outputPath, ".shards.{}.part".format(os.urandom(4).hex()))
+    os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    return filename
+
+def _decodeShard(image, filename):
+    # Decodes the shard in image into its range of filename (see _newShardFile()), so shards can land in any order.
+    # Returns its header, or None if image has no shard
+    header = image.readHeader()
+    if header is None or not header.encoding & ENCODING_SHARDED:
+        return None
+
+    with open(filename, "r+b") as f:
+        f.seek(header.shardOffset)
+        image.decodePayloadTo(f, verbose=False, header=header)
+
+    return header
+
+def _decodeShardJob(job):
+    imageFilename, filename, channelSet = job
+
+    header = _decodeShard(Image(imageFilename, lazy=True, channelSet=channelSet), filename)
+    if header is None:
+        raise ValueError("No payload shard found in '{}'.".format(imageFilename))
+
+    return header
+
+def encodeShards(payload, imageFilenames, outputFilenames, processes=None, verbose=True, channelSet=None):
+    # Encodes payload (read from a path, as shards are handed to workers) across as many of the given
+    # images as needed, each one in its own worker and carrying its shard in channelSet. Returns the output
+    # filenames actually written
+    channelSet = _parseChannelSet(channelSet)
+
+    with multiprocessing.Pool(processes, initializer=_initBatchWorker) as pool:
+        storages = pool.map(_storageJob, [(imageFilename, channelSet) for imageFilename in imageFilenames])
+
+        # Chunk hashes make the header grow with the shard, so plan for the largest one possible
+        shards = planShards(payload.dataSize, payload.getShard(0, 1, 0, payload.dataSize, b"").getHeaderSize(), storages)
+        totalHash = payload.getHash()
+
+        jobs = []
+        for index, (i, offset, size, level) in enumerate(shards):
+            if verbose: print("Shard {}/{}: {} bytes into '{}' using L{}.".format(index+1, len(shards), size, imageFilenames[i], level))
+            jobs.append((imageFilenames[i], payload.getShard(index, len(shards), offset, size, totalHash), outputFilenames[i], channelSet))
+
+        return pool.map(_encodeShardJob, jobs, chunksize=1)
+
+def decodeShards(imageFilenames, outputPath="", processes=None, channelSet=None):
+    # Decodes the shards in the given images (carried in channelSet), in parallel and in whatever order they
+    # finish, into a single file in outputPath. Returns the header of one of its shards
+    if not imageFilenames:
+        raise ValueError("No images given.")
+
+    headers = {}
+    filename = _newShardFile(outputPath)
+    try:
+        jobs = [(imageFilename, filename, channelSet) for imageFilename in imageFilenames]
+        with multiprocessing.Pool(processes, initializer=_initBatchWorker) as pool:
+            for header in pool.imap_unordered(_decodeShardJob, jobs, chunksize=1):
+                _addShard(headers, header)
+
+        return _joinShards(headers, filename, outputPath)
+    except BaseException:
+        os.unlink(filename)
+        raise
+
+def _addShard(headers, header):
+    # Keeps track of the decoded shards by index, all of which must be of the same payload
+    first = next(iter(headers.values()), header)
+    if (header.filename, header.totalHash) != (first.filename, first.totalHash):
+        raise ValueError("Shards of different payloads found ('{}' and '{}').".format(first.filename, header.filename))
+
+    headers[header.shardIndex] = header
+
+def _joinShards(headers, filename, outputPath):
+    # Checks that every shard was decoded into filename and the reassembled file as a whole, and only then
+    # moves it into outputPath under the payload's name. Returns the header of one of them
+    first = next(iter(headers.values()))
+
+    if len(headers) != first.shardCount:
+        missing = sorted(set(range(first.shardCount)) - set(headers))
+        raise ValueError("Missing shards {} of '{}'.".format(missing, first.filename))
+
+    os.truncate(filename, first.totalSize)
+
+    totalHash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            totalHash.update(chunk)
+
+    assert totalHash.digest() == first.totalHash, "Payload integrity check failed. File might be corrupted."
+
+    os.replace(filename, os.path.join(outputPath, os.path.basename(first.filename)))
+    return first
+
+# Multi-frame covers
+
+# Frames (per worker) decoded and handed to workers but not yet written out, bounding the memory used
+FRAMES_IN_FLIGHT = 2
+
+def readFrameShapes(source):
+    # (width, height, channels) of every frame of a multi-frame image (animated GIF/APNG, or anything
+    # imageio reads as several frames) or of every still image in a list of filenames, width being rows
+    if isinstance(source, (list, tuple)):
+        return [readImageShape(filename) for filename in source]
+
+    shape = imageio.v3.improps(source).shape
+    frames = shape[0] if len(shape) == 4 else 1
+    return [(shape[-3], shape[-2], shape[-1])] * frames
+
+def iterFrames(source, channels=None):
+    # Yields (pixels, duration in ms or None) for every frame of source (see readFrameShapes()), decoding
+    # a single frame at a time. Frames are given the same channels (those of the first one by default),
+    # as GIF frames only get an alpha channel when they have transparent pixels
+    if isinstance(source, (list, tuple)):
+        frames = ((Image(filename).data, None) for filename in source)
+    else:
+        frames = _iterFrameFile(source)
+
+    for frame, duration in frames:
+        if frame.ndim != 3 or frame.shape[2] < 3:
+            raise ValueError("Only RGB frames are supported.")
+
+        channels = channels or frame.shape[2]
+        if frame.shape[2] > channels:
+            frame = frame[:, :, :channels]
+        elif frame.shape[2] < channels:
+            frame = np.dstack([frame, np.full(frame.shape[:2], 255, dtype=frame.dtype)])
+
+        yield frame, duration
+
+def _checkFrameSamples(source):
+    # Animations are written and read as 8 bit APNGs, and Pillow cuts 16 bit samples down to 8 bits while
+    # reading them, so frames of 16 bit samples would lose their payload
+    for filename in source if isinstance(source, (list, tuple)) else [source]:
+        if readImageFormat(filename)[1] != 8:
+            raise ValueError("Only frames of 8 bit samples are supported, '{}' has 16 bit ones.".format(filename))
+
+def _iterFrameFile(source):
+    with imageio.v3.imopen(source, "r") as f:
+        for i, frame in enumerate(f.iter()):
+            yield frame.astype(np.uint8, copy=False), f.metadata(index=i).get("duration")
+
+def _frameImage(frame, channelSet=None):
+    # Image over a frame's pixels, without copying them again (through an in-memory raw pixel cache)
+    buffer = io.BytesIO()
+    saveRawCache(frame, buffer)
+    return Image(buffer.getbuffer(), channelSet=channelSet)
+
+class APNGWriter:
+    # Writes an animated PNG frame by frame, each one replacing the whole canvas, so every frame decodes to
+    # exactly the pixels it was given. Frames are written as zlib streams (see _deflatePNGRows())
+    def __init__(self, f, shape, frameCount, loop=0):
+        # shape is (height, width, channels) of every frame, of 8 bit samples. loop 0 repeats forever
+        self.f = f
+        self.sequence = 0
+        self.frames = 0
+        self.frameCount = frameCount
+        self.height, self.width = shape[:2]
+
+        f.write(PNG_SIGNATURE)
+        f.write(_pngHeaderChunk(shape, np.dtype(np.uint8)))
+        f.write(_pngChunk(b"acTL", struct.pack(">II", frameCount, loop)))
+
+    def writeFrame(self, stream, duration=None):
+        # duration in ms, None being as fast as possible
+        delay = (int(round(duration)), 1000) if duration else (0, 1000)
+        self.f.write(_pngChunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence, self.width, self.height, 0, 0, *delay, 0, 0)))
+        self.sequence += 1
+
+        # The first frame is the default image as well, so it's stored as IDAT
+        if self.frames == 0:
+            self.f.write(_pngChunk(b"IDAT", stream))
+        else:
+            self.f.write(_pngChunk(b"fdAT", struct.pack(">I", self.sequence) + stream))
+            self.sequence += 1
+
+        self.frames += 1
+
+    def close(self):
+        if self.frames != self.frameCount:
+            raise ValueError("APNG declared {} frames, but got {}.".format(self.frameCount, self.frames))
+
+        self.f.write(_pngChunk(b"IEND", b""))
+
+def _encodeFrameJob(job):
+    frame, duration, shard, level, channelSet = job
+
+    image = _frameImage(frame, channelSet)
+    if shard is not None:
+        image.encodePayload(shard, verbose=False)
+
+    return b"".join(_deflatePNGRows(image.data, level, 1)), duration
+
+def _decodeFrameJob(job):
+    frame, filename, channelSet = job
+    return _decodeShard(_frameImage(frame, channelSet), filename)
+
+def _boundedMap(pool, function, jobs, maxInFlight):
+    # pool.imap() in order, but only taking up to maxInFlight jobs from the iterator at a time
+    # (imap itself reads them all ahead), so only that many frames are ever in memory
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(function, (job,)))
+        if len(pending) >= maxInFlight:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+def encodeFrames(payload, source, outputFilename, processes=None, compression=None, verbose=True, channelSet=None):
+    # Encodes payload (read from a path, as shards are handed to workers) across the frames of source (see
+    # readFrameShapes()), their capacities adding up. The data is striped over the frames as shards, filling
+    # as few of them as possible at the lowest level possible (see planShards()), and every frame is encoded
+    # (in channelSet) and compressed by a worker while the lossless APNG output is written in order.
+    # compression is a zlib level (0-9) or one of COMPRESSION_PRESETS. Returns the shards as (frame, offset, size, level)
+    channelSet = _parseChannelSet(channelSet)
+    _checkFrameSamples(source)
+
+    shapes = readFrameShapes(source)
+    if len(set(shapes)) > 1:
+        raise ValueError("All frames must have the same dimensions.")
+    if max(channelSet) >= shapes[0][2]:
+        raise ValueError("Channel set {} doesn't fit the {} channels of the frames.".format(channelSet, shapes[0][2]))
+
+    storages = [getStorages(rows * columns, len(channelSet)) for rows, columns, _ in shapes]
+    shards = planShards(payload.dataSize, payload.getShard(0, 1, 0, payload.dataSize, b"").getHeaderSize(), storages)
+    totalHash = payload.getHash()
+
+    frameShards = {}
+    for index, (i, offset, size, level) in enumerate(shards):
+        if verbose: print("Shard {}/{}: {} bytes into frame {} using L{}.".format(index+1, len(shards), size, i, level))
+        frameShards[i] = payload.getShard(index, len(shards), offset, size, totalHash)
+
+    level = COMPRESSION_PRESETS.get(compression, compression)
+    level = 6 if level is None else level
+
+    processes = processes or multiprocessing.cpu_count()
+    with multiprocessing.Pool(processes, initializer=_initBatchWorker) as pool, open(outputFilename, "wb") as f:
+        writer = APNGWriter(f, shapes[0], len(shapes))
+
+        frames = iterFrames(source, shapes[0][2])
+        jobs = ((frame, duration, frameShards.get(i), level, channelSet) for i, (frame, duration) in enumerate(frames))
+
+        for stream, duration in _boundedMap(pool, _encodeFrameJob, jobs, FRAMES_IN_FLIGHT * processes):
+            writer.writeFrame(stream, duration)
+
+        writer.close()
+
+    return shards
+
+def decodeFrames(source, outputPath="", processes=None, channelSet=None):
+    # Decodes a payload encoded by encodeFrames() (in channelSet) into outputPath, streaming the frames of source
+    # through the workers (at most FRAMES_IN_FLIGHT per worker at a time) and stopping as soon as every shard is
+    # found. Returns the header of one of its shards
+    _checkFrameSamples(source)
+
+    headers = {}
+    processes = processes or multiprocessing.cpu_count()
+    filename = _newShardFile(outputPath)
+
+    try:
+        with multiprocessing.Pool(processes, initializer=_initBatchWorker) as pool:
+            jobs = ((frame, filename, channelSet) for frame, _ in iterFrames(source))
+
+            for header in _boundedMap(pool, _decodeFrameJob, jobs, FRAMES_IN_FLIGHT * processes):
+                if header is not None:
+                    _addShard(headers, header)
+                    if len(headers) == header.shardCount:
+                        break
+
+        if not headers:
+            raise ValueError("No payload found in the frames of '{}'.".format(source))
+
+        return _joinShards(headers, filename, outputPath)
+    except BaseException:
+        os.unlink(filename)
+        raise
+
+# Batch processing
+
+# Only lossless formats can carry a payload, so batch decoding only looks at these
+LOSSLESS_EXTENSIONS = (".png", ".bmp", ".tif", ".tiff", RAW_EXTENSION)
+
+REPORT_FIELDS = ["image", "payload", "output", "level", "size", "status", "seconds", "error"]
+SCAN_FIELDS = ["image", "width", "height", "score", "chiSquare", "chiSquareLength", "rsLength", "lsbEntropy", "bitPlaneEntropy", "payload", "status", "seconds", "error"]
+
+def _initBatchWorker():
+    # Batch workers are daemonic and can't start their own pools, every read stays in-process
+    global PARALLEL_READ_THRESHOLD
+    PARALLEL_READ_THRESHOLD = float("inf")
+
+def _encodeFile(imageFilename, payloadFilename, outputFilename, compression=None):
+    # Full encode of one image, returning a report line. Errors are raised
+    image = Image(imageFilename)
+    payload = Payload(payloadFilename)
+
+    # size is the payload data alone, the same as decode rows report
+    result = {"image": imageFilename, "payload": payloadFilename, "size": payload.dataSize}
+    result["level"] = image.getPayloadLevel(payload.getPackedSize())
+
+    image.encodePayload(payload, verbose=False)
+    result["output"] = image.saveFile(outputFilename, compression)
+    result["status"] = "encoded"
+
+    return result
+
+def _decodeToFile(image, filename, header, verbose=False, exclusive=False):
+    # Decodes into a temporary file next to filename, only moved into place once the payload checked out,
+    # so a failed integrity check never leaves a corrupted file behind. With exclusive, filename is claimed
+    # first and an existing one is an error instead of being replaced
+    if exclusive:
+        os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+
+    tempFilename = "{}.{}.part".format(filename, os.urandom(4).hex())
+    fd = os.open(tempFilename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with open(fd, "wb") as f:
+            image.decodePayloadTo(f, verbose=verbose, header=header)
+        os.replace(tempFilename, filename)
+    except BaseException:
+        os.unlink(tempFilename)
+        if exclusive:
+            os.unlink(filename)
+        raise
+
+def _decodeFile(imageFilename, outputPath=""):
+    # Full detection and decode of one image into outputPath, returning a report line. Errors are raised.
+    # Images are opened lazily, as most of them may hold no payload at all
+    image = Image(imageFilename, lazy=True)
+    header = image.readHeader()
+
+    result = {"image": imageFilename}
+    if header is None:
+        result["status"] = "empty"
+        return result
+
+    result["payload"], result["level"], result["size"] = header.filename, header.level, header.dataSize
+
+    # A shard is only part of its payload and can't be checked on its own, the whole set goes through join
+    if header.encoding & ENCODING_SHARDED:
+        result["status"] = "shard {}/{}".format(header.shardIndex+1, header.shardCount)
+        return result
+
+    # The payload's name comes from the image: it's kept inside outputPath and prefixed with the image's
+    # own, as several images may carry payloads of the same name. Those that still collide are errors
+    stem = os.path.splitext(os.path.basename(imageFilename))[0]
+    result["output"] = os.path.join(outputPath, "{}-{}".format(stem, os.path.basename(header.filename)))
+
+    _decodeToFile(image, result["output"], header, exclusive=True)
+    result["status"] = "decoded"
+
+    return result
+
+def _scanFile(imageFilename):
+    # Steganalysis of one image, returning a report line. Errors are raised
+    image = Image(imageFilename)
+
+    result = {"image": imageFilename}
+    result.update(analyzeImage(image))
+
+    # Our own payloads are found for sure through their header
+    header = image.readHeader()
+    if header is not None:
+        result["payload"], result["status"] = header.filename, "payload"
+    else:
+        result["status"] = "suspicious" if result["score"] >= SUSPICION_THRESHOLD else "clean"
+
+    return result
+
+def _reportJob(function, job, result):
+    # Runs function(*job), turning errors into the report line's status
+    t0 = time()
+    try:
+        result = function(*job)
+    except Exception as e:
+        result["status"], result["error"] = "error", str(e)
+
+    result["seconds"] = round(time() - t0, 3)
+    return result
+
+def _encodeJob(job):
+    return _reportJob(_encodeFile, job, {"image": job[0], "payload": job[1], "output": job[2]})
+
+def _decodeJob(job):
+    return _reportJob(_decodeFile, job, {"image": job[0]})
+
+def _scanJob(job):
+    return _reportJob(_scanFile, job, {"image": job[0]})
+
+def _runBatch(worker, jobs, processes=None):
+    # One image per task, at most `processes` of them in flight, results yielded as they finish
+    with multiprocessing.Pool(processes, initializer=_initBatchWorker) as pool:
+        yield from pool.imap_unordered(worker, jobs, chunksize=1)
+
+def readManifest(filename):
+    # CSV lines of (imageFilename, payloadFilename, outputFilename). Blank lines and '#' comments are skipped
+    with open(filename, newline="") as f:
+        return [tuple(field.strip() for field in row) for row in csv.reader(f) if row and not row[0].startswith("#")]
+
+def batchEncode(jobs, processes=None):
+    return _runBatch(_encodeJob, jobs, processes)
+
+def batchDecode(imageFilenames, outputPath="", processes=None):
+    return _runBatch(_decodeJob, [(imageFilename, outputPath) for imageFilename in imageFilenames], processes)
+
+def scanImages(imageFilenames, processes=None):
+    # analyzeImage() of every image, one per worker, yielding report lines (see SCAN_FIELDS) as they finish
+    return _runBatch(_scanJob, [(imageFilename,) for imageFilename in imageFilenames], processes)
+
+def writeReport(results, filename, fields=REPORT_FIELDS):
+    # Writes each result as soon as it arrives, so a partial report survives an interrupted batch.
+    # Filenames ending with .json get a JSON array of results instead of CSV
+    with open(filename, "w", newline="") as f:
+        if filename.lower().endswith(".json"):
+            f.write("[")
+            for i, result in enumerate(results):
+                f.write((",\n " if i else "\n ") + json.dumps({field: result[field] for field in fields if field in result}))
+                f.flush()
+                yield result
+            f.write("\n]\n")
+            return
+
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+
+        for result in results:
+            writer.writerow(result)
+            f.flush()
+            yield result
+
+# Asynchronous API
+
+def _discardOutput(future):
+    # Removes what a job cancelled while running wrote, once it's done
+    if future.cancelled() or future.exception() is not None or not isinstance(future.result(), dict):
+        return
+
+    output = future.result().get("output")
+    if output is not None and os.path.exists(output):
+        os.remove(output)
+
+class AsyncStegoEngine:
+    # Runs whole encode/decode jobs (image I/O included) on a shared process pool, so an asyncio event
+    # loop only ever awaits them. At most maxJobs run at once, the rest wait without taking a worker.
+    # Cancelling a job that is still waiting drops it; one already running finishes in its worker (keeping
+    # its place among the maxJobs until then), and its result and output file are discarded
+    def __init__(self, processes=None, maxJobs=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.maxJobs = maxJobs or self.processes
+        self._executor = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _run(self, function, *args):
+        if self._executor is None:
+            # Workers can't start pools of their own, every read stays in-process
+            self._executor = futures.ProcessPoolExecutor(self.processes, initializer=_initBatchWorker)
+            self._semaphore = asyncio.Semaphore(self.maxJobs)
+
+        await self._semaphore.acquire()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        # Released when the job is done in its worker rather than when the task awaiting it is, which may be
+        # cancelled while the job keeps running
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._semaphore.release))
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(_discardOutput)
+            raise
+
+    async def encode(self, imageFilename, payloadFilename, outputFilename, compression=None):
+        # Returns a report line like batchEncode()'s, errors are raised
+        return await self._run(_encodeFile, imageFilename, payloadFilename, outputFilename, compression)
+
+    async def decode(self, imageFilename, outputPath=""):
+        # Returns a report line like batchDecode()'s (status "empty" if there's no payload, "shard i/n" for
+        # a shard, which isn't written), errors are raised
+        return await self._run(_decodeFile, imageFilename, outputPath)
+
+    async def close(self):
+        if self._executor is not None:
+            executor, self._executor = self._executor, None
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+
+def _popOption(args, name, default=None):
+    # Removes "name value" from args, returning value
+    if name not in args:
+        return default
+
+    i = args.index(name)
+    value = args[i+1]
+    del args[i:i+2]
+    return value
+
+# Daemon mode
+
+# Socket the daemon listens on by default (STEGOPACK_SOCKET overrides it)
+DEFAULT_DAEMON_SOCKET = "/tmp/StegoPack-{}.sock".format(os.getuid())
+
+class _DaemonOutput(io.TextIOBase):
+    # stdout (and stderr) of a call run by the daemon, sent to its client as it's written
+    def __init__(self, f):
+        self._f = f
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._f.write(json.dumps({"out": text}) + "\n")
+        self._f.flush()
+        return len(text)
+
+def runDaemon(socketPath=DEFAULT_DAEMON_SOCKET):
+    # Serves CLI calls (see runOnDaemon()) on a Unix socket from this interpreter, so they skip its startup and
+    # imports, and reuse its worker pool (getWorkerPool()). Calls run one at a time, as each one works in its
+    # client's directory and prints to its client
+    import signal
+    import socket
+    import traceback
+
+    # Stopped by SIGTERM (or Ctrl+C), cleaning up its socket either way. The handler may run inside a destructor
+    # (e.g. while a connection is closed), where its SystemExit is swallowed, so the loop checks for it as well
+    stopped = False
+    def stop(*args):
+        nonlocal stopped
+        stopped = True
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    if runOnDaemon(None, socketPath) is not None:
+        raise ValueError("A daemon is already listening on '{}'.".format(socketPath))
+    if os.path.lexists(socketPath):
+        # Only a socket left behind by a daemon that was killed is removed, anything else is in the way
+        if not stat.S_ISSOCK(os.lstat(socketPath).st_mode):
+            raise ValueError("'{}' exists and isn't a socket.".format(socketPath))
+        os.unlink(socketPath)
+
+    # Everything a call may need is loaded before the first one comes in, the worker pool too unless reads
+    # would never use it (see Image._readsInParallel())
+    _importLazyModules("np", "imageio", "multiprocessing", "futures")
+    if getWorkerPool().processes > 1:
+        getWorkerPool()._getPool()
+
+    # Calls run as this user, in any directory of the client's choosing, so only this user may connect
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    os.chmod(socketPath, 0o600)
+    server.listen()
+    print("Listening on '{}'.".format(socketPath))
+
+    try:
+        while not stopped:
+            connection, _ = server.accept()
+            cwd = os.getcwd()
+            try:
+                with connection, connection.makefile("rw", encoding="UTF-8") as f:
+                    request = json.loads(f.readline() or "null")
+                    if request is None:
+                        continue
+
+                    output = _DaemonOutput(f)
+                    os.chdir(request["cwd"])
+                    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                        try:
+                            code = main(request["argv"]) or 0
+                        except Exception:
+                            traceback.print_exc()
+                            code = 1
+
+                    f.write(json.dumps({"exit": code}) + "\n")
+            except OSError: # Client gone mid-call
+                pass
+            finally:
+                os.chdir(cwd)
+    finally:
+        server.close()
+        os.unlink(socketPath)
+
+def runOnDaemon(argv, socketPath=DEFAULT_DAEMON_SOCKET):
+    # Runs a CLI call (argv[0] being the program name) on the daemon listening on socketPath, printing its
+    # output as it comes. Returns its exit code, or None if no daemon is listening there
+    import socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socketPath)
+    except OSError:
+        client.close()
+        return None
+
+    with client, client.makefile("rw", encoding="UTF-8") as f:
+        if argv is None: # Only checking
+            return 0
+
+        f.write(json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+        f.flush()
+
+        for line in f:
+            message = json.loads(line)
+            if "exit" in message:
+                return message["exit"]
+
+            print(message["out"], end="", flush=True)
+
+    raise ConnectionError("Daemon on '{}' went away during the call.".format(socketPath))
+
+# Command line interface
+
+def main(argv):
+    # Runs a CLI call (argv[0] being the program name). Returns an exit code, None being success
+    argv = list(argv)
+
+    # Profiling: print per-phase stats at the end, or save them as JSON
+    profile = "--profile" in argv
+    if profile:
+        argv.remove("--profile")
+    profileFilename = _popOption(argv, "--profile-json")
+    stats = Stats() if profile or profileFilename else None
+
+    # Imports get a phase of their own, instead of being billed to the first phase using them
+    if stats is not None:
+        with stats.phase("import"):
+            _importLazyModules("np", "imageio")
+
+    compression = _popOption(argv, "--compression")
+    if compression is not None and compression not in COMPRESSION_PRESETS:
+        compression = int(compression)
+
+    # Hash the payload in chunks of this many bytes, to verify it chunk by chunk while decoding
+    chunkSize = int(_popOption(argv, "--chunk-size", 0)) or None
+    if chunkSize is not None and not 0 < chunkSize <= MAX_HASH_CHUNK_SIZE:
+        print("--chunk-size must be between 1 and {} bytes.".format(MAX_HASH_CHUNK_SIZE))
+        return 1
+
+    # Compress the payload before encoding it: METHOD or METHOD:LEVEL
+    payloadCompression = _popOption(argv, "--payload-compression")
+
+    # Spread the payload over the image with a key, needed again to decode it
+    key = _popOption(argv, "--key")
+
+    # Channels carrying the payload (e.g. rgba to use alpha too), needed again to decode it
+    channelSet = _popOption(argv, "--channels")
+
+    # Encode only what doesn't fit at L0 at a higher level
+    mixed = "--mixed" in argv
+    if mixed:
+        argv.remove("--mixed")
+
+    # Daemon serving later calls from a warm interpreter
+    if argv[1:2] == ["daemon"]:
+        try:
+            runDaemon(argv[2] if len(argv) >= 3 else os.environ.get("STEGOPACK_SOCKET", DEFAULT_DAEMON_SOCKET))
+        except ValueError as e:
+            print(e)
+            return 1
+        return
+
+    command = argv[1] if len(argv) >= 3 and argv[1] in ["batch", "split", "join", "animate", "extract", "convert", "plan", "scan", "info"] else None
 
     # Help info
-    if len(argv) != 2 and len(argv) != 4:
+    if not command and len(argv) != 2 and len(argv) != 4:
         prog = argv[0]
 
         print("Usage:")
         print("  python3 {} (imageFilename)".format(prog))
         print("    > Get info about file storage capacity and check if there's a payload")
+        print("  python3 {} info (imageFilename)...".format(prog))
+        print("    > Get info about file storage capacity from the file headers alone, without decoding any image")
         print("  python3 {} (imageFilename) (payloadFilename) (outputFilename)".format(prog))
         print("    > Store payload into image and output a new PNG image")
+        print("    > Add --compression (0-9 or {}) to write the PNG with a given zlib level over multiple threads".format("/".join(COMPRESSION_PRESETS)))
+        print("    > Add --chunk-size (bytes) to hash the payload in chunks, verified in parallel while decoding")
+        print("    > Add --payload-compression ({}/auto)[:level] to compress the payload first, if that makes it smaller".format("/".join(PAYLOAD_COMPRESSORS)))
+        print("    > Add --mixed to only encode what doesn't fit at L0 at a higher level")
+        print("  Add --key (key) to spread the payload over the image in a keyed pseudorandom order, needed again to decode it")
+        print("  Add --channels (rgba) to pick the channels carrying the payload (RGB by default), needed again to decode it")
+        print("  Add --profile to print time spent per phase, or --profile-json (filename) to save it")
+        print("  python3 {} batch (manifestFilename) [--jobs N] [--report reportFilename]".format(prog))
+        print("    > Encode every (imageFilename, payloadFilename, outputFilename) line of a CSV manifest")
+        print("  python3 {} batch (imageDirectory) (outputDirectory) [--jobs N] [--report reportFilename]".format(prog))
+        print("    > Scan every image in a directory and decode found payloads into outputDirectory")
+        print("  python3 {} scan (imageDirectory) [--jobs N] [--report reportFilename]".format(prog))
+        print("    > Run LSB steganalysis over every image in a directory, scoring how likely each one is to hold a payload")
+        print("  python3 {} split (payloadFilename) (outputDirectory) (imageFilename)...".format(prog))
+        print("    > Split payload across as few images as needed, at the lowest level possible")
+        print("  python3 {} join (outputDirectory) (imageFilename)...".format(prog))
+        print("    > Reassemble a payload split across images")
+        print("  python3 {} animate (payloadFilename) (outputFilename) (imageFilename)... [--jobs N]".format(prog))
+        print("    > Stripe payload across the frames of an animated GIF/APNG (or of a sequence of images) into an APNG")
+        print("  python3 {} extract (outputDirectory) (animationFilename) [--jobs N]".format(prog))
+        print("    > Decode a payload striped across the frames of an APNG")
+        print("  python3 {} plan (payloadFilename) (imageFilename)...".format(prog))
+        print("    > Rank images by how little encoding payload into them would distort them, without decoding any")
+        print("  python3 {} convert (imageFilename) (outputFilename)".format(prog))
+        print("    > Convert an image to a raw pixel cache (if outputFilename ends with '{}') or back to PNG".format(RAW_EXTENSION))
+        print("  python3 {} daemon [socketPath]".format(prog))
+        print("    > Serve later calls from this process, sent to it when STEGOPACK_SOCKET is set to socketPath")
         
-        exit()
+        return
+
+    # Header-only file info
+    if command == "info":
+        for filename in argv[2:]:
+            printImageInfo(filename, channelSet)
+        return
+
+    # Capacity planning
+    if command == "plan":
+        payloadFilename, imageFilenames = argv[2], argv[3:]
+
+        levels, subpixels, psnr = planCapacities(imageFilenames, [payloadFilename], channelSet)
+        ranking = rankCovers(imageFilenames, [payloadFilename], channelSet)[0]
+
+        for i in ranking:
+            print("L{}  {:>12} subpixels  {:6.2f} dB  {}".format(levels[0, i], subpixels[0, i], psnr[0, i], imageFilenames[i]))
+
+        if len(ranking) < len(imageFilenames):
+            print("'{}' doesn't fit into {} of the {} images.".format(os.path.split(payloadFilename)[-1], len(imageFilenames) - len(ranking), len(imageFilenames)))
+        return
+
+    # Raw pixel cache conversion
+    if command == "convert":
+        image = Image(argv[2])
+
+        if argv[3].lower().endswith(RAW_EXTENSION):
+            outputFilename = image.saveRaw(argv[3])
+        else:
+            outputFilename = image.saveFile(argv[3], compression)
+
+        print("Saved to '{}'!".format(outputFilename))
+        return
+
+    # Multi-image payloads
+    if command == "split":
+        payloadFilename, outputDirectory, imageFilenames = argv[2], argv[3], argv[4:]
+        os.makedirs(outputDirectory, exist_ok=True)
+
+        outputFilenames = [os.path.join(outputDirectory, os.path.split(f)[-1]) for f in imageFilenames]
+
+        t0 = time()
+        try:
+            outputFilenames = encodeShards(Payload(payloadFilename, chunkSize=chunkSize), imageFilenames, outputFilenames, channelSet=channelSet)
+        except ValueError as e:
+            print(e)
+            return
+
+        print("Saved to {}! Took {:.2f}s.".format(", ".join("'{}'".format(f) for f in outputFilenames), time()-t0))
+        return
+
+    if command == "join":
+        outputDirectory, imageFilenames = argv[2], argv[3:]
+        os.makedirs(outputDirectory, exist_ok=True)
+
+        t0 = time()
+        try:
+            header = decodeShards(imageFilenames, outputDirectory, channelSet=channelSet)
+        except (ValueError, AssertionError) as e:
+            print(e)
+            return
+
+        print("Saved to '{}'! Took {:.2f}s.".format(os.path.join(outputDirectory, os.path.basename(header.filename)), time()-t0))
+        return
+
+    # Multi-frame covers
+    if command == "animate":
+        args = argv[2:]
+        processes = int(_popOption(args, "--jobs", 0)) or None
+        payloadFilename, outputFilename, imageFilenames = args[0], args[1], args[2:]
+
+        t0 = time()
+        try:
+            encodeFrames(Payload(payloadFilename, chunkSize=chunkSize), imageFilenames[0] if len(imageFilenames) == 1 else imageFilenames, outputFilename, processes, compression, channelSet=channelSet)
+        except ValueError as e:
+            print(e)
+            return
+
+        print("Saved to '{}'! Took {:.2f}s.".format(outputFilename, time()-t0))
+        return
+
+    if command == "extract":
+        args = argv[2:]
+        processes = int(_popOption(args, "--jobs", 0)) or None
+        outputDirectory, animationFilename = args
+        os.makedirs(outputDirectory, exist_ok=True)
+
+        t0 = time()
+        try:
+            header = decodeFrames(animationFilename, outputDirectory, processes, channelSet=channelSet)
+        except (ValueError, AssertionError) as e:
+            print(e)
+            return
+
+        print("Saved to '{}'! Took {:.2f}s.".format(os.path.join(outputDirectory, os.path.basename(header.filename)), time()-t0))
+        return
+
+    # Steganalysis
+    if command == "scan":
+        args = argv[2:]
+        processes = int(_popOption(args, "--jobs", 0)) or None
+        reportFilename = _popOption(args, "--report", "scan.csv")
+
+        t0 = time()
+        imageFilenames = sorted(os.path.join(args[0], f) for f in os.listdir(args[0]) if f.lower().endswith(LOSSLESS_EXTENSIONS))
+
+        counts = {}
+        for result in writeReport(scanImages(imageFilenames, processes), reportFilename, SCAN_FIELDS):
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+            if "error" in result:
+                print("[error] {}: {}".format(result["image"], result["error"]))
+            else:
+                print("[{}] {} (score {:.2f})".format(result["status"], result["image"], result["score"]))
+
+        summary = ", ".join("{} {}".format(n, status) for status, n in sorted(counts.items()))
+        print("Done in {:.2f}s ({}). Report saved to '{}'.".format(time()-t0, summary or "nothing to do", reportFilename))
+        return
+
+    # Batch encoding / decoding
+    if command == "batch":
+        args = argv[2:]
+        processes = int(_popOption(args, "--jobs", 0)) or None
+        reportFilename = _popOption(args, "--report", "report.csv")
+
+        t0 = time()
+        if len(args) == 2 and os.path.isdir(args[0]):
+            imageDirectory, outputDirectory = args
+            os.makedirs(outputDirectory, exist_ok=True)
+
+            imageFilenames = sorted(os.path.join(imageDirectory, f) for f in os.listdir(imageDirectory) if f.lower().endswith(LOSSLESS_EXTENSIONS))
+            results = batchDecode(imageFilenames, outputDirectory, processes)
+        else:
+            results = batchEncode(readManifest(args[0]), processes)
+
+        counts = {}
+        for result in writeReport(results, reportFilename):
+            status = result["status"].split()[0] # Shards counted together
+            counts[status] = counts.get(status, 0) + 1
+            print("[{}] {}{}".format(result["status"], result["image"], ": " + result["error"] if "error" in result else ""))
+
+        summary = ", ".join("{} {}".format(n, status) for status, n in sorted(counts.items()))
+        print("Done in {:.2f}s ({}). Report saved to '{}'.".format(time()-t0, summary or "nothing to do", reportFilename))
+        if "shard" in counts:
+            print("Shards aren't decoded on their own, use 'join' with all of their images.")
+        return
 
     # File info / decoding
     if len(argv) == 2:
         filename = argv[1]
 
-        image = Image(filename)
+        image = Image(filename, stats=stats, key=key, lazy=True, channelSet=channelSet)
         image.printInfo()
 
         t0 = time()
-        try:
-            payload = image.decodePayload()
-        except ValueError as e:
-            print(e)
-            exit()
+        header = image.readHeader()
+        if header is None:
+            print("No payload found in '{}'.".format(filename))
+            return
+
+        if header.encoding & ENCODING_SHARDED:
+            print("Found shard {} of {} of '{}', use 'join' with all of its images.".format(header.shardIndex+1, header.shardCount, header.filename))
+            return
+
+        # Stream the payload straight to disk instead of holding it in memory, into the current directory
+        outputFilename = os.path.basename(header.filename)
+        _decodeToFile(image, outputFilename, header, verbose=True)
 
         t1 = time()
 
-        payload.saveFile()
-        print("Saved to '{}'! Took {:.2f}s.".format(payload.filename, t1-t0))
+        print("Saved to '{}'! Took {:.2f}s.".format(outputFilename, t1-t0))
 
     # File encoding
     if len(argv) == 4:
         imgInputFilename, payloadFilename, imgOutputFilename = argv[1:]
 
-        image = Image(imgInputFilename)
+        image = Image(imgInputFilename, stats=stats, key=key, channelSet=channelSet)
         image.printInfo()
 
-        payload = Payload(payloadFilename)
+        payload = Payload(payloadFilename, chunkSize=chunkSize)
+        if payloadCompression is not None:
+            method, _, level = payloadCompression.partition(":")
+            compressed = payload.compress(method, int(level or 6))
+
+            if compressed is payload:
+                print("'{}' doesn't get any smaller with {}, encoding it as is.".format(payload.filename, method))
+            else:
+                print("'{}' compressed from {} to {} ({}).".format(payload.filename, formatBytes(payload.dataSize), formatBytes(compressed.dataSize), compressed.compressionMethod))
+            payload = compressed
+
         payload.printInfo()
 
         t0 = time()
-        image.encodePayload(payload)
+        image.encodePayload(payload, mixed=mixed)
         t1 = time()
 
-        imgOutputFilename = image.saveFile(imgOutputFilename)
-        print("Saved to '{}'! Took {:.2f}s.".format(imgOutputFilename, t1-t0))
\ No newline at end of file
+        if imgOutputFilename.lower().endswith(RAW_EXTENSION):
+            imgOutputFilename = image.saveRaw(imgOutputFilename)
+        else:
+            imgOutputFilename = image.saveFile(imgOutputFilename, compression)
+        t2 = time()
+
+        print("Saved to '{}'! Took {:.2f}s ({:.2f}s writing).".format(imgOutputFilename, t2-t0, t2-t1))
+
+    if stats is not None:
+        if profile:
+            stats.printInfo()
+
+        if profileFilename:
+            with open(profileFilename, "w") as f:
+                json.dump(stats.toDict(), f, indent=2)
+
+# Star imports only get the API: neither the modules (or functions) imported here nor the _LazyModule stand-ins for them
+__all__ = [name for name, value in globals().items() if not name.startswith("_")
+           and not isinstance(value, (_LazyModule, type(os))) and getattr(value, "__module__", __name__) == __name__]
+
+# Standalone execution
+if __name__ == "__main__":
+    import sys
+
+    # With STEGOPACK_SOCKET set, calls go to the daemon listening there if there is one
+    socketPath = os.environ.get("STEGOPACK_SOCKET")
+    if socketPath and sys.argv[1:2] != ["daemon"]:
+        code = runOnDaemon(sys.argv, socketPath)
+        if code is not None:
+            sys.exit(code)
+
+    sys.exit(main(sys.argv))
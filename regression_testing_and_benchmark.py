@@ -1,59 +1,654 @@
+import statistics
+import argparse
+import tempfile
+import resource
 import hashlib
+import json
+import sys
+import io
 import os
-from time import time
+import multiprocessing
+import traceback
+import contextlib
+import stat
+import asyncio
+from time import perf_counter, sleep
 
+import numpy as np
+import imageio
+
+import StegoPack
 from StegoPack import *
 
-def test(cleanImageFilename, payloadFilename, fillRandom=False):
-    encodedImageFilename = "out.png"
-    extractedPayloadFilename = "out-" + payloadFilename
+# Regression testing and benchmark harness.
+#
+# Runs every (level, image size, payload fill) combination on synthetic covers, each in its own process
+# so peak memory can be measured per case, and times every phase separately over repeated trials:
+#   load   - Image() of the clean cover
+#   embed  - Image.encodePayload()
+#   write  - Image.saveFile()
+#   detect - Image.readHeader() on the encoded image
+#   decode - Image.decodePayloadTo() (header already read)
+# Every decoded payload is checked against the original, and with --baseline any phase whose median got
+# slower than the baseline by more than --threshold fails the run.
+#
+# Cases also run for every payload layout in --variants, a '+' separated set of VARIANTS (plain is none),
+# so each on-disk layout gets a roundtrip check. Before them, the CHECKS in --checks exercise what the cases
+# don't go through (batch mode, sharding...) once each, also in a process of their own.
+
+PHASES = ["load", "embed", "write", "detect", "decode"]
+
+# Payloads just past the start of each level's capacity range and close to its end, see --fills
+DEFAULT_FILLS = [0.01, 0.9]
+
+# Payload layouts and read paths cases can run with:
+#   chunked    - ENCODING_CHUNKED payload, verified chunk by chunk
+#   compressed - compressible payload, ENCODING_COMPRESSED
+#   keyed      - payload scattered with a key
+#   mixed      - mixed L0/higher level layout (ENCODING_MIXED)
+#   rgba16     - 16 bit RGBA cover, alpha included in the channel set
+#   parallel   - reads done by a worker pool, however small
+VARIANTS = ["chunked", "compressed", "keyed", "mixed", "rgba16", "parallel"]
+DEFAULT_VARIANTS = ["plain", "chunked", "compressed", "keyed", "mixed", "rgba16", "parallel", "parallel+chunked", "parallel+keyed+mixed"]
+
+VARIANT_KEY = b"regression"
+VARIANT_CHUNK_SIZE = 1 << 16
+PARALLEL_WORKERS = 2
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DEMO_CASES = [
+    ("demo_files/corgi-599x799.jpg", "demo_files/payloads/faustao.png"), # L0
+    ("demo_files/nightfall-1920x1080.jpg", "demo_files/payloads/hap.mp4"), # L1
+    ("demo_files/randall-2560x1372.png", "demo_files/payloads/pier39.mp4"), # L2
+]
+
+def parseSize(size):
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+def payloadSizeFor(image, payloadFilename, level, fill):
+    # Data size landing at `fill` of the way through the level's capacity range (header included)
+    storages = [0] + image.storages
+    headerSize = Payload(io.BytesIO(), name=os.path.basename(payloadFilename)).getHeaderSize()
+
+    packedSize = storages[level] + 1 + int(fill * (storages[level+1] - storages[level] - 1))
+    return max(packedSize - headerSize, 1)
+
+def parseVariant(variant):
+    features = set(variant.split("+")) - {"plain"}
+    unknown = features - set(VARIANTS)
+    if unknown:
+        raise ValueError("Unknown variants: {}".format(", ".join(sorted(unknown))))
+    return features
+
+def makeSyntheticCase(directory, width, height, level, fill, features=()):
+    # Noise cover (the worst case for PNG compression) and random payload. The compressed variant gets a
+    # payload of 2 bit symbols instead, a quarter of it once compressed
+    rng = np.random.default_rng(width * height + level)
+
+    if "rgba16" in features:
+        coverFilename = os.path.join(directory, "cover-{}x{}-rgba16.png".format(width, height))
+        if not os.path.exists(coverFilename):
+            with open(coverFilename, "wb") as f:
+                writePNG(f, rng.integers(0, 1 << 16, (height, width, 4), dtype=np.uint16))
+    else:
+        coverFilename = os.path.join(directory, "cover-{}x{}.png".format(width, height))
+        if not os.path.exists(coverFilename):
+            imageio.imwrite(coverFilename, rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+    kind = "rgba16" if "rgba16" in features else "compressed" if "compressed" in features else "plain"
+    payloadFilename = os.path.join(directory, "payload-L{}-{}x{}-{}-{}.bin".format(level, width, height, fill, kind))
+    if not os.path.exists(payloadFilename):
+        payloadSize = payloadSizeFor(Image(coverFilename, channelSet=imageOptions(features).get("channelSet")), payloadFilename, level, fill)
+        with open(payloadFilename, "wb") as f:
+            f.write(rng.integers(0, 4, payloadSize, dtype=np.uint8).tobytes() if kind == "compressed" else rng.bytes(payloadSize))
+
+    return coverFilename, payloadFilename
+
+def imageOptions(features, pool=None):
+    options = {}
+    if "keyed" in features:
+        options["key"] = VARIANT_KEY
+    if "rgba16" in features:
+        options["channelSet"] = "rgba"
+    if pool is not None:
+        options["pool"] = pool
+    return options
+
+def runCase(case):
+    # Runs inside a fresh process, so ru_maxrss is this case's own peak (parallel reads' workers aside)
+    name, coverFilename, payloadFilename, trials, compression, variant = case
+    directory = os.path.dirname(payloadFilename)
+    encodedFilename = os.path.join(directory, "encoded-{}.png".format(os.getpid()))
+
+    features = parseVariant(variant)
+    pool = None
+    if "parallel" in features:
+        StegoPack.PARALLEL_READ_THRESHOLD = 1
+        pool = WorkerPool(PARALLEL_WORKERS)
+
+    with open(payloadFilename, "rb") as f:
+        payloadHash = hashlib.sha256(f.read()).digest()
+
+    timings = {phase: [] for phase in PHASES}
+    result = {"name": name, "ok": True}
+
+    for trial in range(trials):
+        t0 = perf_counter()
+        image = Image(coverFilename, **imageOptions(features))
+        t1 = perf_counter()
+        payload = Payload(payloadFilename, chunkSize=VARIANT_CHUNK_SIZE if "chunked" in features else None)
+        if "compressed" in features:
+            payload = payload.compress()
+        image.encodePayload(payload, verbose=False, mixed="mixed" in features)
+        t2 = perf_counter()
+        image.saveFile(encodedFilename, compression)
+        t3 = perf_counter()
+
+        encoded = Image(encodedFilename, **imageOptions(features, pool))
+        t4 = perf_counter()
+        header = encoded.readHeader()
+        t5 = perf_counter()
+
+        decoded = io.BytesIO()
+        encoded.decodePayloadTo(decoded, verbose=False, header=header)
+        t6 = perf_counter()
+
+        for phase, seconds in zip(PHASES, [t1-t0, t2-t1, t3-t2, t5-t4, t6-t5]):
+            timings[phase].append(seconds)
+
+        if hashlib.sha256(decoded.getvalue()).digest() != payloadHash:
+            result["ok"] = False
+
+        encoded.close()
+
+    os.remove(encodedFilename)
+    if pool is not None:
+        pool.shutdown()
+
+    result.update({
+        "image": "{}x{}".format(image.height, image.width),
+        "level": header.level,
+        "payloadBytes": header.dataSize,
+        "medians": {phase: statistics.median(seconds) for phase, seconds in timings.items()},
+        "peakRSS": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, # KB on Linux
+    })
+    result["throughput"] = {phase: header.dataSize / seconds / 2**20 if seconds > 0 else None for phase, seconds in result["medians"].items()}
+
+    return result
+
+def _sendResult(connection, function, args):
+    connection.send((function(*args),))
+    connection.close()
+
+def runInProcess(function, *args):
+    # function(*args) in a fresh process, not a pool worker: those are daemonic and can't start worker pools of their own
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_sendResult, args=(sender, function, args))
+    process.start()
+    sender.close()
+
+    try:
+        result, = receiver.recv()
+    except EOFError: # Died without a result
+        process.join()
+        raise RuntimeError("{}{} failed (exit code {}).".format(function.__name__, args[:1], process.exitcode))
+
+    process.join()
+    return result
+
+# Functional checks. Each one gets a scratch directory of its own and fails by raising
+
+def makeCover(filename, width, height, seed, channels=3, dtype=np.uint8):
+    # Noise cover, saved with writePNG() so 16 bit samples are kept
+    rng = np.random.default_rng(seed)
+    with open(filename, "wb") as f:
+        writePNG(f, rng.integers(0, np.iinfo(dtype).max, (height, width, channels), dtype=dtype, endpoint=True))
+    return filename
+
+def makePayload(filename, size, seed):
+    with open(filename, "wb") as f:
+        f.write(np.random.default_rng(seed).bytes(size))
+    return filename
+
+def readFile(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+def checkBatch(directory):
+    # batchEncode()/batchDecode() on a worker pool, with two payloads of the same name and an image without any
+    os.makedirs(os.path.join(directory, "other"))
+    payloads = [makePayload(os.path.join(directory, "same.bin"), 3000, 1), makePayload(os.path.join(directory, "other", "same.bin"), 2000, 2)]
+    jobs = [(makeCover(os.path.join(directory, "cover{}.png".format(i)), 96, 64, i), payload, os.path.join(directory, "encoded{}.png".format(i))) for i, payload in enumerate(payloads)]
+
+    results = sorted(batchEncode(jobs, processes=2), key=lambda result: result["image"])
+    assert [result["status"] for result in results] == ["encoded", "encoded"], results
+    assert [result["size"] for result in results] == [3000, 2000], results
+
+    outputPath = os.path.join(directory, "out")
+    os.makedirs(outputPath)
+    imageFilenames = [job[2] for job in jobs] + [makeCover(os.path.join(directory, "empty.png"), 96, 64, 3)]
+    results = {result["image"]: result for result in batchDecode(imageFilenames, outputPath, processes=2)}
+
+    assert results[imageFilenames[2]]["status"] == "empty", results
+    for (_, payload, encoded) in jobs:
+        assert results[encoded]["status"] == "decoded", results
+        assert results[encoded]["size"] == os.path.getsize(payload), results
+        assert readFile(results[encoded]["output"]) == readFile(payload), "Decoded payload of '{}' doesn't match".format(encoded)
+
+    # Decoding again into the same directory reports collisions instead of overwriting
+    results = list(batchDecode(imageFilenames[:2], outputPath, processes=2))
+    assert all(result["status"] == "error" for result in results), results
+
+def checkShards(directory):
+    # encodeShards()/decodeShards() roundtrip, a corrupted or missing shard leaving the output directory as it was,
+    # and shards up to L3 on 16 bit covers
+    payload = makePayload(os.path.join(directory, "split.bin"), 9000, 4)
+    covers = [makeCover(os.path.join(directory, "cover{}.png".format(i)), 64, 48, i) for i in range(3)]
+    encoded = [os.path.join(directory, "shard{}.png".format(i)) for i in range(3)]
+
+    encoded = encodeShards(Payload(payload), covers, encoded, processes=2, verbose=False)
+    assert len(encoded) == 3, "Expected the payload split across all 3 covers, got {}".format(encoded)
+
+    outputPath = os.path.join(directory, "out")
+    os.makedirs(outputPath)
+    header = decodeShards(encoded[::-1], outputPath, processes=2)
+    assert header.totalSize == 9000 and readFile(os.path.join(outputPath, "split.bin")) == readFile(payload), "Joined payload doesn't match"
+
+    # Flip a few LSBs of a shard's data
+    image = Image(encoded[1])
+    image.data[4:6] ^= 1
+    corrupted = image.saveFile(os.path.join(directory, "corrupted.png"))
+
+    for imageFilenames, error in [(encoded[:2], ValueError), ([encoded[0], corrupted, encoded[2]], AssertionError)]:
+        try:
+            decodeShards(imageFilenames, outputPath, processes=2)
+        except error:
+            pass
+        else:
+            raise AssertionError("decodeShards({}) didn't raise {}".format(imageFilenames, error.__name__))
+
+        assert os.listdir(outputPath) == ["split.bin"], "Failed join left {}".format(os.listdir(outputPath))
+        assert readFile(os.path.join(outputPath, "split.bin")) == readFile(payload), "Failed join changed the existing output"
+
+    # Covers of 16 bit samples go up to L3, also along an 8 bit one, and with alpha in the channel set a level lower
+    cover16 = makeCover(os.path.join(directory, "cover16.png"), 64, 48, 3, channels=4, dtype=np.uint16)
+    for i, (covers, channelSet, size, levels) in enumerate([([covers[0], cover16], None, 12000, [2, 3]), ([cover16], None, 5000, [3]), ([cover16], "rgba", 5000, [2])]):
+        deepPath = os.path.join(directory, "deep{}".format(i))
+        os.makedirs(deepPath)
+        payload = makePayload(os.path.join(directory, "deep{}.bin".format(i)), size, i)
+
+        encoded = encodeShards(Payload(payload), covers, [os.path.join(deepPath, "shard{}.png".format(j)) for j in range(len(covers))], processes=2, verbose=False, channelSet=channelSet)
+        encodedLevels = [Image(filename, channelSet=channelSet).readHeader().level for filename in encoded]
+        assert encodedLevels == levels, "{} byte payload split at {}, expected {}".format(size, encodedLevels, levels)
+
+        decodeShards(encoded, deepPath, processes=2, channelSet=channelSet)
+        assert readFile(os.path.join(deepPath, os.path.basename(payload))) == readFile(payload), "Joined {} byte payload doesn't match".format(size)
+
+def checkReadRange(directory):
+    # PayloadHeader.readRange() against the payload itself, at every level, plain, keyed, mixed and chunked
+    # (with ranges across chunk boundaries), plus its out of range and compressed errors
+    cover = makeCover(os.path.join(directory, "cover.png"), 96, 64, 0)
+    chunkSize = 1000
+    rng = np.random.default_rng(0)
 
-    image = Image(cleanImageFilename)
-    payload = Payload(payloadFilename)
+    for size in [1500, 4000, 8000]: # L0, L1, L2
+        data = readFile(makePayload(os.path.join(directory, "range.bin"), size, size))
+        for features in [set(), {"keyed"}, {"mixed"}, {"chunked"}, {"keyed", "mixed", "chunked"}]:
+            image = Image(cover, **imageOptions(features))
+            image.encodePayload(Payload(data, name="range.bin", chunkSize=chunkSize if "chunked" in features else None), verbose=False, mixed="mixed" in features)
+            encodedFilename = os.path.join(directory, "encoded.png")
+            image.saveFile(encodedFilename)
 
-    t0 = time()
-    image.encodePayload(payload, fillRandom)
-    t1 = time()
+            header = Image(encodedFilename, **imageOptions(features)).readHeader()
+            ranges = [(0, 0), (0, 1), (0, size), (size, 0), (size - 1, 1), (chunkSize - 1, 2), (chunkSize, size - chunkSize), (1, size - 2)]
+            for _ in range(20):
+                offset = int(rng.integers(0, size))
+                ranges.append((offset, int(rng.integers(0, size - offset, endpoint=True))))
 
-    image.saveFile(encodedImageFilename)
-    print("Encoding took {:.3f}s.".format(t1-t0))
+            for offset, length in ranges:
+                assert header.readRange(offset, length) == data[offset:offset+length], \
+                    "readRange({}, {}) of a {} byte payload ({}) doesn't match".format(offset, length, size, "+".join(sorted(features)) or "plain")
 
-    image = Image(encodedImageFilename)
+            for offset, length in [(-1, 1), (0, -1), (size, 1), (size - 1, 2)]:
+                try:
+                    header.readRange(offset, length)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("readRange({}, {}) of a {} byte payload didn't raise ValueError".format(offset, length, size))
 
-    t2 = time()
-    payload = image.decodePayload()
-    t3 = time()
+    image = Image(cover)
+    image.encodePayload(Payload(bytes(4000), name="zeros.bin").compress(), verbose=False)
+    image.saveFile(encodedFilename)
+    try:
+        Image(encodedFilename).readHeader().readRange(0, 1)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("readRange() of a compressed payload didn't raise ValueError")
 
-    payload.saveFile()
-    print("Decoding took {:.3f}s.".format(t3-t2))
+def checkPlanner(directory):
+    # planCapacities() from file headers alone against the Image() of every cover: RGB and grayscale JPEGs,
+    # RGB and 16 bit RGBA PNGs, with and without alpha in the channel set, for payloads right at each level's
+    # capacity and one byte past it
+    rng = np.random.default_rng(0)
+    covers = [
+        makeCover(os.path.join(directory, "rgb.png"), 96, 64, 0),
+        makeCover(os.path.join(directory, "rgba16.png"), 40, 30, 1, channels=4, dtype=np.uint16),
+        os.path.join(directory, "rgb.jpg"),
+        os.path.join(directory, "gray.jpg"),
+    ]
+    imageio.imwrite(covers[2], rng.integers(0, 256, (48, 64, 3), dtype=np.uint8))
+    imageio.imwrite(covers[3], rng.integers(0, 256, (48, 64), dtype=np.uint8))
 
-    # os.remove(encodedImageFilename)
-    os.remove(payloadFilename.split("/")[-1])
+    for channelSet in [None, "rgba"]:
+        storages = []
+        for cover in covers:
+            try:
+                storages.append(Image(cover, channelSet=channelSet).storages)
+            except ValueError: # Not a cover with this channel set, e.g. grayscale
+                storages.append([])
+
+        headerSize = Payload(b"", name="plan.bin").getHeaderSize()
+        packedSizes = sorted({size + extra for row in storages for size in row for extra in [0, 1]} | {headerSize + 1})
+        payloads = [Payload(bytes(size - headerSize), name="plan.bin") for size in packedSizes]
+        levels, subpixels, psnr = planCapacities(covers, payloads, channelSet)
+
+        for p, packedSize in enumerate(packedSizes):
+            for i, cover in enumerate(covers):
+                level = next((level for level, size in enumerate(storages[i]) if packedSize <= size), None)
+                where = "{} byte payload into '{}' ({})".format(packedSize, os.path.basename(cover), channelSet or "rgb")
+
+                assert levels[p, i] == (-1 if level is None else level), "Planned L{} for a {}, Image() gives L{}".format(levels[p, i], where, level)
+                if level is None:
+                    assert subpixels[p, i] == 0 and np.isnan(psnr[p, i]), "Planned subpixels or PSNR for a {} that doesn't fit".format(where)
+                else:
+                    assert subpixels[p, i] == packedSize * (8 // 2**level), "Planned {} subpixels for a {}".format(subpixels[p, i], where)
+                    assert np.isfinite(psnr[p, i]), "Planned PSNR {} for a {}".format(psnr[p, i], where)
+
+        fitting = [[i for i in range(len(covers)) if levels[p, i] >= 0] for p in range(len(payloads))]
+        assert [sorted(row) for row in rankCovers(covers, payloads, channelSet)] == fitting, "rankCovers() doesn't rank exactly the covers that fit"
+
+    assert planCapacity(covers[3], payloads[0])["level"] is None, "Grayscale JPEG planned as a cover"
+
+def checkMixed(directory):
+    # Mixed layouts at the edge of a level: the low-size field must never push a payload fitting L1 on its own up
+    # to L2, it's left plain at L1 instead (80x60 RGB: L1 holds 3600 bytes). Below that, payloads whose L0 part
+    # can't hold the header are plain too
+    cover = makeCover(os.path.join(directory, "cover.png"), 80, 60, 0)
+    headerSize = Payload(b"", name="mixed.bin").getHeaderSize()
+    lastMixed = 3600 - MIXED_FIELDS_SIZE - (headerSize + MIXED_FIELDS_SIZE) # L0 part of (3600 - packedSize - 8) bytes
+
+    for packedSize, expected in [(3000, (1, True)), (lastMixed, (1, True)), (lastMixed + 1, (1, False)), (3596, (1, False)), (3600, (1, False)), (3601, (2, True))]:
+        data = readFile(makePayload(os.path.join(directory, "mixed.bin"), packedSize - headerSize, packedSize))
+
+        image = Image(cover)
+        image.encodePayload(Payload(data, name="mixed.bin"), verbose=False, mixed=True)
+        encodedFilename = image.saveFile(os.path.join(directory, "encoded.png"))
+
+        encoded = Image(encodedFilename)
+        header = encoded.readHeader()
+        layout = (header.level, bool(header.encoding & ENCODING_MIXED))
+        assert layout == expected, "{} byte payload encoded at {}, expected {}".format(packedSize, layout, expected)
+
+        decoded = io.BytesIO()
+        encoded.decodePayloadTo(decoded, verbose=False, header=header)
+        assert decoded.getvalue() == data, "Decoded {} byte payload doesn't match".format(packedSize)
+
+def checkFrames(directory):
+    # encodeFrames()/decodeFrames() roundtrip over three frames, then the frames as still images with one
+    # missing, one corrupted, none carrying a payload or of 16 bit samples: each must fail and leave the output
+    # directory untouched
+    covers = [makeCover(os.path.join(directory, "cover{}.png".format(i)), 64, 48, i) for i in range(3)]
+    payload = makePayload(os.path.join(directory, "frames.bin"), 3000, 1)
+    animationFilename = os.path.join(directory, "animation.png")
+
+    shards = encodeFrames(Payload(payload), covers, animationFilename, processes=2, verbose=False)
+    assert sorted(shard[0] for shard in shards) == [0, 1, 2], "Payload wasn't striped across every frame: {}".format(shards)
+
+    outputPath = os.path.join(directory, "out")
+    os.makedirs(outputPath)
+    decodeFrames(animationFilename, outputPath, processes=2)
+    assert readFile(os.path.join(outputPath, "frames.bin")) == readFile(payload), "Decoded payload doesn't match"
+
+    frames = []
+    for i, frame in enumerate(imageio.v3.imread(animationFilename, index=None)):
+        frames.append(os.path.join(directory, "frame{}.png".format(i)))
+        with open(frames[-1], "wb") as f:
+            writePNG(f, frame)
+
+    corrupted = imageio.v3.imread(frames[1])
+    corrupted.reshape(-1)[4000:4100] ^= 1
+    frames.append(os.path.join(directory, "corrupted.png"))
+    with open(frames[-1], "wb") as f:
+        writePNG(f, corrupted)
+
+    # Frames of 16 bit samples are rejected rather than cut down to 8 bits
+    cover16 = makeCover(os.path.join(directory, "cover16.png"), 64, 48, 3, channels=4, dtype=np.uint16)
+    try:
+        encodeFrames(Payload(payload), [cover16] * 3, os.path.join(directory, "animation16.png"), processes=2, verbose=False)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("encodeFrames() took frames of 16 bit samples")
+
+    for source, error in [(frames[:2], ValueError), ([frames[0], frames[3], frames[2]], AssertionError), (covers, ValueError), ([cover16] * 3, ValueError)]:
+        try:
+            decodeFrames(source, outputPath, processes=2)
+        except error:
+            pass
+        else:
+            raise AssertionError("decodeFrames({}) didn't raise {}".format(source, error.__name__))
+
+        assert os.listdir(outputPath) == ["frames.bin"], "Failed decode left {}".format(os.listdir(outputPath))
+        assert readFile(os.path.join(outputPath, "frames.bin")) == readFile(payload), "Failed decode changed the existing output"
+
+def _sleepJob(seconds):
+    t0 = perf_counter()
+    sleep(seconds)
+    return t0, perf_counter()
+
+async def _checkAsync(directory):
+    payload = makePayload(os.path.join(directory, "async.bin"), 2000, 5)
+    covers = [makeCover(os.path.join(directory, "cover{}.png".format(i)), 64, 48, i) for i in range(2)]
+    bigCover = makeCover(os.path.join(directory, "big.png"), 1920, 1080, 2)
+
+    async with AsyncStegoEngine(processes=2, maxJobs=1) as engine:
+        # Roundtrip, with more jobs than maxJobs
+        encoded = [os.path.join(directory, "encoded{}.png".format(i)) for i in range(2)]
+        results = await asyncio.gather(*[engine.encode(cover, payload, output) for cover, output in zip(covers, encoded)])
+        assert [result["status"] for result in results] == ["encoded", "encoded"], results
+
+        outputPath = os.path.join(directory, "out")
+        os.makedirs(outputPath)
+        results = await asyncio.gather(*[engine.decode(filename, outputPath) for filename in encoded])
+        assert all(readFile(result["output"]) == readFile(payload) for result in results), "Decoded payload doesn't match"
+
+        # At most maxJobs at once, even when a running job is cancelled
+        spans = await asyncio.gather(engine._run(_sleepJob, 0.2), engine._run(_sleepJob, 0.2))
+        (_, firstEnd), (secondStart, _) = sorted(spans)
+        assert secondStart >= firstEnd, "maxJobs=1 jobs overlapped: {}".format(spans)
+
+        t0 = perf_counter()
+        running = asyncio.ensure_future(engine._run(_sleepJob, 0.5))
+        await asyncio.sleep(0.2)
+        running.cancel()
+        start, _ = await engine._run(_sleepJob, 0)
+        assert start >= t0 + 0.5, "A job started while a cancelled one was still running"
+
+        # A job cancelled while running finishes in its worker, but its output is removed; one still waiting never runs
+        running = asyncio.ensure_future(engine.encode(bigCover, payload, os.path.join(directory, "cancelled.png")))
+        waiting = asyncio.ensure_future(engine.encode(covers[0], payload, os.path.join(directory, "waiting.png")))
+        await asyncio.sleep(0.1)
+        running.cancel()
+        waiting.cancel()
+
+    assert not os.path.exists(os.path.join(directory, "cancelled.png")), "Output of a cancelled running job was kept"
+    assert not os.path.exists(os.path.join(directory, "waiting.png")), "A cancelled waiting job ran"
+
+def checkAsync(directory):
+    # AsyncStegoEngine roundtrip, its maxJobs cap and cancellation
+    asyncio.run(_checkAsync(directory))
+
+def _runQuietDaemon(socketPath):
+    with contextlib.redirect_stdout(io.StringIO()):
+        runDaemon(socketPath)
+
+def checkDaemon(directory):
+    # CLI calls through runDaemon() and runOnDaemon(): encode, decode (in the caller's directory) and a failing
+    # call, a socket only its user can use, refusing a second daemon or a non-socket path, and SIGTERM cleaning up
+    socketPath = os.path.join(directory, "daemon.sock")
+    daemon = multiprocessing.Process(target=_runQuietDaemon, args=(socketPath,))
+    daemon.start()
+
+    try:
+        t0 = perf_counter()
+        while runOnDaemon(None, socketPath) is None:
+            assert daemon.is_alive() and perf_counter() - t0 < 30, "Daemon didn't start listening"
+            sleep(0.05)
+
+        assert stat.S_IMODE(os.stat(socketPath).st_mode) == 0o600, "Daemon socket has mode {:o}".format(os.stat(socketPath).st_mode)
+
+        cover = makeCover(os.path.join(directory, "cover.png"), 96, 64, 0)
+        payload = makePayload(os.path.join(directory, "daemon.bin"), 3000, 1)
+        outputPath = os.path.join(directory, "out")
+        os.makedirs(outputPath)
+        os.chdir(outputPath) # This check's process is its own
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            assert runOnDaemon(["StegoPack.py", cover, payload, "encoded.png"], socketPath) == 0, output.getvalue()
+            assert runOnDaemon(["StegoPack.py", "encoded.png"], socketPath) == 0, output.getvalue()
+            assert runOnDaemon(["StegoPack.py", "missing.png"], socketPath) == 1, output.getvalue()
+        assert "FileNotFoundError" in output.getvalue(), "Failing call's traceback wasn't sent back"
+        assert readFile(os.path.join(outputPath, "daemon.bin")) == readFile(payload), "Payload decoded by the daemon doesn't match"
+
+        for path in [socketPath, payload]:
+            try:
+                runDaemon(path)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("runDaemon('{}') didn't raise ValueError".format(path))
+    finally:
+        daemon.terminate()
+        daemon.join(10)
+        if daemon.is_alive():
+            daemon.kill()
+            raise AssertionError("Daemon didn't stop on SIGTERM")
+
+    assert daemon.exitcode == 0, "Daemon exited with {} on SIGTERM".format(daemon.exitcode)
+    assert not os.path.exists(socketPath), "Daemon left its socket behind"
+
+CHECKS = {
+    "batch": checkBatch,
+    "shards": checkShards,
+    "frames": checkFrames,
+    "readRange": checkReadRange,
+    "planner": checkPlanner,
+    "mixed": checkMixed,
+    "async": checkAsync,
+    "daemon": checkDaemon,
+}
+
+def runCheck(name, directory):
+    # Returns None if the check passed, the traceback otherwise
+    os.makedirs(directory)
+    try:
+        CHECKS[name](directory)
+    except Exception:
+        return traceback.format_exc()
+
+def compareToBaseline(results, baseline, threshold, minDelta):
+    # Returns a message for every phase that got slower than its baseline median by more than threshold
+    # (and by more than minDelta seconds, so sub-millisecond phases don't fail on noise)
+    baselineMedians = {result["name"]: result["medians"] for result in baseline["results"]}
+
+    regressions = []
+    for result in results:
+        for phase, seconds in result["medians"].items():
+            before = baselineMedians.get(result["name"], {}).get(phase)
+            if before and seconds > before * (1 + threshold) and seconds - before > minDelta:
+                regressions.append("{} {}: {:.4f}s -> {:.4f}s (+{:.0%})".format(result["name"], phase, before, seconds, seconds/before - 1))
+
+    return regressions
+
+def printResult(result):
+    print("{:<40} {:>10} {:>5}  ".format(result["name"], formatBytes(result["payloadBytes"]), "L{}".format(result["level"])), end="")
+    print("  ".join("{} {:7.4f}s ({:8.1f} MB/s)".format(phase, result["medians"][phase], result["throughput"][phase] or float("inf")) for phase in PHASES), end="")
+    print("  peak RSS {}{}".format(formatBytes(result["peakRSS"]), "" if result["ok"] else "  DECODED PAYLOAD MISMATCH"))
 
 if __name__ == "__main__":
-    test("demo_files/corgi-599x799.jpg", "demo_files/payloads/faustao.png") # L0
-    '''
-    Encoding 'faustao.png' into 'demo_files/corgi-599x799.jpg' using L0...
-    Encoding took 0.443s.
-    File 'faustao.png' found encoded as L0!
-    Decoding...
-    Decoding took 0.925s.
-    '''
-
-    test("demo_files/nightfall-1920x1080.jpg", "demo_files/payloads/hap.mp4") # L1
-    '''
-    Encoding 'hap.mp4' into 'demo_files/nightfall-1920x1080.jpg' using L1...
-    Encoding took 2.972s.
-    File 'hap.mp4' found encoded as L1!
-    Decoding...
-    Decoding took 3.029s.
-    '''
-
-    test("demo_files/randall-2560x1372.png", "demo_files/payloads/pier39.mp4") # L2
-    '''
-    Encoding 'pier39.mp4' into 'demo_files/randall-2560x1372.png' using L2...
-    Encoding took 4.436s.
-    File 'pier39.mp4' found encoded as L2!
-    Decoding...
-    Decoding took 3.964s.
-    '''
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="StegoPack regression tests and benchmark.")
+    parser.add_argument("--sizes", default="640x480,1920x1080", help="comma separated synthetic cover sizes (WIDTHxHEIGHT)")
+    parser.add_argument("--levels", default="0,1,2", help="comma separated levels to benchmark")
+    parser.add_argument("--fills", default=",".join(map(str, DEFAULT_FILLS)), help="comma separated payload sizes, as fractions of each level's capacity range")
+    parser.add_argument("--variants", default=",".join(DEFAULT_VARIANTS), help="comma separated payload layouts, each a '+' separated set of: plain, {}".format(", ".join(VARIANTS)))
+    parser.add_argument("--checks", default=",".join(CHECKS), help="comma separated functional checks to run first (empty for none): {}".format(", ".join(CHECKS)))
+    parser.add_argument("--trials", type=int, default=5, help="trials per case, medians are reported")
+    parser.add_argument("--compression", default=None, help="saveFile() compression level or preset")
+    parser.add_argument("--demo", action="store_true", help="also run the demo_files image/payload pairs")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown over the baseline (0.2 = 20%%)")
+    parser.add_argument("--min-delta", type=float, default=0.001, help="slowdowns of fewer seconds than this are ignored")
+    args = parser.parse_args()
+
+    compression = int(args.compression) if args.compression and args.compression.isdigit() else args.compression
+
+    with tempfile.TemporaryDirectory() as directory:
+        failedChecks = []
+        for name in filter(None, args.checks.split(",")):
+            t0 = perf_counter()
+            error = runInProcess(runCheck, name, os.path.join(directory, "check-" + name))
+            print("check {:<34} {} ({:.2f}s)".format(name, "ok" if error is None else "FAILED", perf_counter() - t0))
+            if error is not None:
+                print(error)
+                failedChecks.append(name)
+
+        cases = []
+        for variant in args.variants.split(","):
+            features = parseVariant(variant)
+            for size in args.sizes.split(","):
+                width, height = parseSize(size)
+                for level in map(int, args.levels.split(",")):
+                    for fill in map(float, args.fills.split(",")):
+                        # Plain cases keep their names, so older baselines still match
+                        name = "L{}-{}x{}-{}".format(level, width, height, fill) + ("-" + variant if features else "")
+                        coverFilename, payloadFilename = makeSyntheticCase(directory, width, height, level, fill, features)
+                        cases.append((name, coverFilename, payloadFilename, args.trials, compression, variant))
+
+        if args.demo:
+            for coverFilename, payloadFilename in DEMO_CASES:
+                name = "demo-" + os.path.splitext(os.path.basename(coverFilename))[0]
+                cases.append((name, os.path.join(ROOT, coverFilename), os.path.join(directory, os.path.basename(payloadFilename)), args.trials, compression, "plain"))
+                with open(os.path.join(ROOT, payloadFilename), "rb") as src, open(cases[-1][2], "wb") as dst:
+                    dst.write(src.read())
+
+        results = []
+        for case in cases:
+            result = runInProcess(runCase, case)
+            printResult(result)
+            results.append(result)
+
+    report = {"trials": args.trials, "compression": args.compression, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = [result["name"] for result in results if not result["ok"]]
+    if failed:
+        print("Decoded payload didn't match the original in: {}".format(", ".join(failed)))
+    if failedChecks:
+        print("Failed checks: {}".format(", ".join(failedChecks)))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareToBaseline(results, json.load(f), args.threshold, args.min_delta)
+
+        for regression in regressions:
+            print("Slower than baseline: " + regression)
+
+    sys.exit(1 if failed or failedChecks or regressions else 0)